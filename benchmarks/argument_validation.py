@@ -0,0 +1,88 @@
+"""
+Compare the per-request cost of validating an endpoint's arguments with the
+validator that AbstractEndpoint.register compiles, against interpreting the
+endpoint's "parameters" dictionary on every request (as get_safe_arguments
+used to), and the same for serving /help.
+
+Usage: python3 benchmarks/argument_validation.py [CALLS]
+
+Doesn't touch the database.
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "brainspell"))
+
+import json_api
+from base_handler import AbstractEndpoint, format_help
+
+
+def interpreted_validation(parameters, arguments_dict, accessor):
+    """ The loop that get_safe_arguments used to run on every request. """
+
+    args = {}
+    for k in parameters:
+        if k not in arguments_dict:
+            if "default" not in parameters[k]:
+                return {
+                    "success": 0,
+                    "description": "Missing required parameter: " + k
+                }
+            else:
+                args[k] = parameters[k]["type"](parameters[k]["default"])
+        else:
+            try:
+                args[k] = parameters[k]["type"](accessor(k))
+            except BaseException:
+                return {
+                    "success": 0,
+                    "description": "Bad input for argument (type " +
+                    parameters[k]["type"].__name__ +
+                    "): " +
+                    k
+                }
+    for k in arguments_dict:
+        if k not in parameters:
+            return {
+                "success": 0,
+                "description": "Unexpected parameter: " + k
+            }
+
+    return {
+        "success": 1,
+        "args": args
+    }
+
+
+def per_call(fn, calls):
+    """ Return the average time of fn(), in microseconds. """
+
+    return timeit.timeit(fn, number=calls) / calls * 1e6
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # the endpoint behind /json/query, with a typical request's arguments
+    endpoint = json_api.QueryEndpointHandler
+    AbstractEndpoint.register(endpoint)
+    arguments = {"q": "working memory", "start": "10"}
+    accessor = arguments.get
+
+    print("{0:<12}{1:>14}{2:>12}".format("", "interpreted", "compiled"))
+    print("{0:<12}{1:>12.2f}us{2:>10.2f}us".format(
+        "validation",
+        per_call(lambda: interpreted_validation(
+            endpoint.parameters, arguments, accessor), calls),
+        per_call(lambda: endpoint.validator(arguments, accessor), calls)))
+    print("{0:<12}{1:>12.2f}us{2:>10.2f}us".format(
+        "/help",
+        per_call(lambda: json.dumps(format_help(endpoint.parameters)), calls),
+        per_call(lambda: endpoint.help_json, calls)))
+
+
+if __name__ == "__main__":
+    main()
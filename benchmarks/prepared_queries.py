@@ -0,0 +1,70 @@
+"""
+Compare the per-call cost of the single-row lookups in
+brainspell/prepared_queries.py with the PeeWee queries that they replaced.
+
+Usage: python3 benchmarks/prepared_queries.py [PMID] [CALLS]
+
+Runs against the database in DATABASE_URL (or the default Heroku database),
+so the timings include the round trip to Postgres. Each lookup is run once
+before timing, so that its statement is already prepared.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "brainspell"))
+
+from models import *
+from prepared_queries import (ARTICLE_FIELDS, article_exists, fetch_article,
+                              fetch_user)
+
+
+def orm_fetch_article(pmid):
+    return list(Articles.select(*ARTICLE_FIELDS).where(
+        Articles.pmid == str(pmid)).execute())
+
+
+def orm_article_exists(pmid):
+    return Articles.select(Articles.pmid).where(
+        Articles.pmid == str(pmid)).execute().count
+
+
+def orm_fetch_user(api_key):
+    return list(User.select(User.userid, User.username).where(
+        User.password == api_key).limit(1).execute())
+
+
+def compile_fetch_article(pmid):
+    return Articles.select(*ARTICLE_FIELDS).where(
+        Articles.pmid == str(pmid)).sql()
+
+
+def per_call(fn, arg, calls):
+    """ Return the average time of fn(arg), in microseconds. """
+
+    fn(arg)
+    return timeit.timeit(lambda: fn(arg), number=calls) / calls * 1e6
+
+
+def main():
+    pmid = sys.argv[1] if len(sys.argv) > 1 else "10022492"
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    # an API key that doesn't exist costs the same to look up as one that does
+    api_key = "benchmark-api-key"
+    comparisons = [
+        ("article by PMID", orm_fetch_article, fetch_article, pmid),
+        ("PMID exists", orm_article_exists, article_exists, pmid),
+        ("user by API key", orm_fetch_user, fetch_user, api_key)
+    ]
+    print("{0:<18}{1:>12}{2:>12}".format("lookup", "peewee", "prepared"))
+    for name, before, after, arg in comparisons:
+        print("{0:<18}{1:>10.1f}us{2:>10.1f}us".format(
+            name, per_call(before, arg, calls), per_call(after, arg, calls)))
+    print("(building the article query alone costs {0:.1f}us)".format(
+        per_call(compile_fetch_article, pmid, calls)))
+
+
+if __name__ == "__main__":
+    main()
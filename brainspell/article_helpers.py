@@ -1,182 +1,236 @@
 # functions related to adding and editing article data
 
+import json
 import re
 import urllib.request
 
 import Bio
 from Bio import Entrez, Medline
 from Bio.Entrez import efetch, esearch, parse, read
+from psycopg2.extras import Json
 
+import search_index
 from models import *
-from search_helpers import get_article_object
+from prepared_queries import ARTICLE_FIELDS, article_exists
+from search_helpers import invalidate_experiment_searches, invalidate_searches
 
 Entrez.email = "neel@berkeley.edu"
 
 # BEGIN: article helper functions
 
 
-def update_authors(pmid, authors):
-    """ Update the authors for an article. """
+def send_post_save(pmids, created=False):
+    """
+    Send PeeWee's post_save signal for articles that were written with bulk
+    INSERT or UPDATE queries, which don't send it themselves. Only the
+    in-memory search index listens for it, so skip the query unless that
+    index is in use.
+    """
 
-    Articles.update(authors=authors).where(Articles.pmid == pmid).execute()
+    if not search_index.index.ready:
+        return
+    for article in Articles.select(*ARTICLE_FIELDS).where(
+            Articles.pmid << [str(p) for p in pmids]).execute():
+        signals.post_save.send(article, created=created)
 
 
-def update_vote_in_struct(struct, tag_name, username, direction, label_name):
-    """ Update a voting structure to toggle a user's vote. Modifies the input structure. """
-
-    # get the index for the tag
-    entry = -1
-    for i in range(len(struct)):
-        # some entries might be malformed, so check if "tag" is in the dict
-        if label_name in struct[i]:
-            if struct[i][label_name] == tag_name:
-                entry = i
-                break
-    if entry == -1:  # if the tag hasn't been added yet, then add it
-        struct.append({
-            label_name: tag_name,
-        })
-        entry = len(struct) - 1
-
-    # if no one has voted, then add voting structures
-    if "vote" not in struct[entry]:
-        struct[entry]["vote"] = {}
-        struct[entry]["vote"]["up"] = []
-        struct[entry]["vote"]["down"] = []
-
-    # toggle the vote
-    toggled = False
-    for v in range(len(struct[entry]["vote"][direction])):
-        if struct[entry]["vote"][direction][v]["username"] == username:
-            del struct[entry]["vote"][direction][v]
-            toggled = True
-
-    if not toggled:
-        struct[entry]["vote"][direction].append({
-            "username": username  # leave open for any other metadata we may eventually want to include
-        })
+def update_authors(pmid, authors):
+    """ Update the authors for an article. """
 
-    # delete any votes in the opposite direction
-    otherDirectionLst = ["up", "down"]
-    otherDirection = otherDirectionLst[-1 *
-                                       otherDirectionLst.index(direction) + 1]
-    for v in range(len(struct[entry]["vote"][otherDirection])):
-        if struct[entry]["vote"][otherDirection][v]["username"] == username:
-            del struct[entry]["vote"][otherDirection][v]
+    Articles.update(authors=authors).where(Articles.pmid == pmid).execute()
+    invalidate_searches()
+    send_post_save([pmid])
+
+
+# the name of the Counters row with the number of articles
+ARTICLES_COUNTER = "articles"
+
+# BEGIN: vote helper functions
+
+# What a vote is about, in Votes.target. Votes are stored one row per user,
+# so that each vote is a single atomic statement, and they're folded back
+# into the article's metadata and experiments when it's read (merge_votes).
+MESH_TARGET = "mesh:"  # followed by the name of the MeSH heading
+EXPERIMENT_TARGET = "experiment:"  # followed by "[id]:[column]:[tag]"
+SPACE_TARGET = "space"
+SUBJECTS_TARGET = "nsubjects"
+USER_TAG_TARGET = "user_tag"
+
+# Toggle a vote: remove it if it exists with the same value (from any user,
+# if {owner} is TRUE), and otherwise insert it, or replace the user's vote.
+TOGGLE_VOTE_SQL = """
+    WITH removed AS (
+        DELETE FROM votes
+        WHERE pmid = %(pmid)s AND target = {target} AND value = %(value)s
+        AND {owner}
+        RETURNING 1)
+    INSERT INTO votes (pmid, target, username, value)
+    SELECT %(pmid)s, {target}, %(username)s, %(value)s
+    WHERE NOT EXISTS (SELECT 1 FROM removed)
+    ON CONFLICT (pmid, target, username) DO UPDATE SET value = EXCLUDED.value"""
+SET_VOTE_SQL = """
+    INSERT INTO votes (pmid, target, username, value)
+    VALUES (%(pmid)s, %(target)s, %(username)s, %(value)s)
+    ON CONFLICT (pmid, target, username) DO UPDATE SET value = EXCLUDED.value"""
+# a target for a tag on the experiment table at index %(index)s
+EXPERIMENT_TARGET_SQL = """
+    ('""" + EXPERIMENT_TARGET + """' || (
+        SELECT experiment FROM experiments WHERE pmid = %(pmid)s
+        ORDER BY position OFFSET %(index)s LIMIT 1) || ':' || %(target)s)"""
+# add a MeSH heading to an article, unless it's already there
+ADD_MESH_HEADING_SQL = """
+    UPDATE articles SET metadata = jsonb_set(
+        COALESCE(metadata, '{}'), '{meshHeadings}',
+        COALESCE(metadata->'meshHeadings', '[]') || %(heading)s)
+    WHERE pmid = %(pmid)s
+    AND NOT COALESCE(metadata->'meshHeadings', '[]') @> %(heading)s"""
 
 
 def toggle_vote(pmid, topic, username, direction):
     """ Toggle a user's vote on an article tag. """
 
-    fullArticle = next(get_article_object(pmid))
-
-    metadata = eval(fullArticle.metadata)
-
-    update_vote_in_struct(
-        metadata['meshHeadings'],
-        topic,
-        username,
-        direction,
-        "name")
-
-    query = Articles.update(
-        metadata=metadata).where(
-        Articles.pmid == pmid)
-    query.execute()
+    pmid = str(pmid)
+    # the vote and the heading that it may add are written together
+    with conn.atomic():
+        conn.execute_sql(
+            TOGGLE_VOTE_SQL.format(
+                target="%(target)s", owner="username = %(username)s"), {
+                "pmid": pmid,
+                "target": MESH_TARGET + topic,
+                "username": username,
+                "value": direction
+            })
+
+        # voting on a new tag adds a MeSH heading
+        added = conn.execute_sql(ADD_MESH_HEADING_SQL, {
+            "pmid": pmid,
+            "heading": Json([{"name": topic}])
+        }).rowcount
+    if added:
+        invalidate_searches()
+        send_post_save([pmid])
 
 
 def vote_stereotaxic_space(pmid, space, username):
     """ Toggle a user's vote for the stereotaxic space of an article. """
 
-    fullArticle = next(get_article_object(pmid))
-
-    target = eval(fullArticle.metadata)
-
-    if "space_subjects" not in target:
-        target["space_subjects"] = {}
-
-    if "radio_votes" not in target["space_subjects"]:
-        target["space_subjects"]["radio_votes"] = []
-
-    for i in range(len(target["space_subjects"]["radio_votes"])):
-        if target["space_subjects"]["radio_votes"][i]["username"] == username:
-            del target["space_subjects"]["radio_votes"][i]
-
-    target["space_subjects"]["radio_votes"].append({
+    conn.execute_sql(SET_VOTE_SQL, {
+        "pmid": str(pmid),
+        "target": SPACE_TARGET,
         "username": username,
-        "type": space
+        "value": space
     })
 
-    query = Articles.update(
-        metadata=target).where(
-        Articles.pmid == pmid)
-    query.execute()
-
 
 def vote_number_of_subjects(pmid, subjects, username):
     """ Place a vote for the number of subjects for this article. """
 
-    fullArticle = next(get_article_object(pmid))
+    conn.execute_sql(SET_VOTE_SQL, {
+        "pmid": str(pmid),
+        "target": SUBJECTS_TARGET,
+        "username": username,
+        "value": str(subjects)
+    })
 
-    target = eval(fullArticle.metadata)
 
-    if "space_subjects" not in target:
-        target["space_subjects"] = {}
+def toggle_user_tag(user_tag, pmid, username):
+    """ Toggle a custom user tag to the database. """
 
-    if "number_of_subjects" not in target["space_subjects"]:
-        target["space_subjects"]["number_of_subjects"] = []
+    # if the tag is already present, then delete it (whoever added it);
+    # otherwise, it replaces the user's tag
+    conn.execute_sql(
+        TOGGLE_VOTE_SQL.format(target="%(target)s", owner="TRUE"), {
+            "pmid": str(pmid),
+            "target": USER_TAG_TARGET,
+            "username": username,
+            "value": user_tag
+        })
 
-    for i in range(len(target["space_subjects"]["number_of_subjects"])):
-        if target["space_subjects"]["number_of_subjects"][i]["username"] == username:
-            del target["space_subjects"]["number_of_subjects"][i]
 
-    target["space_subjects"]["number_of_subjects"].append({
-        "username": username,
-        "value": subjects
-    })
+def get_votes(pmid):
+    """ Return the Votes for an article, in the order they were cast. """
 
-    query = Articles.update(
-        metadata=target).where(
-        Articles.pmid == pmid)
-    query.execute()
+    return Votes.select().where(
+        Votes.pmid == str(pmid)).order_by(Votes.uniqueid).execute()
 
 
-def toggle_user_tag(user_tag, pmid, username):
-    """ Toggle a custom user tag to the database. """
+def add_vote(struct, label_name, tag_name, username, direction):
+    """
+    Add a vote to a list of tags, in the format that votes were stored in
+    before the Votes table: [{label_name: tag_name, "vote": {"up": [...],
+    "down": [...]}}]. Modifies the input structure.
+    """
 
-    main_target = next(
-        Articles.select(
-            Articles.metadata).where(
-            Articles.pmid == pmid).execute())
-    target = eval(main_target.metadata)
-
-    if "user_tags" in target:
-        toggled = False
-
-        for user in target["user_tags"]:
-            # if the tag is already present, then delete it
-            if target["user_tags"][user]["tag_name"] == user_tag:
-                del target["user_tags"][user]
-                toggled = True
-                break
-
-        if not toggled:
-            target["user_tags"][username] = {
-                "tag_name": user_tag
-            }
+    for entry in struct:
+        # some entries might be malformed, so check for the label
+        if isinstance(entry, dict) and entry.get(label_name) == tag_name:
+            break
     else:
-        target["user_tags"] = {
-            username: {
-                "tag_name": user_tag
+        entry = {label_name: tag_name}
+        struct.append(entry)
+    if not isinstance(entry.get("vote"), dict):
+        entry["vote"] = {"up": [], "down": []}
+    entry["vote"].setdefault(direction, []).append({"username": username})
+
+
+def merge_votes(votes, metadata, experiments):
+    """
+    Fold an article's votes into its metadata and experiments (as returned
+    by get_experiments), in the structures that clients expect. Modifies
+    both.
+    """
+
+    by_id = {exp["id"]: exp for exp in experiments}
+    for vote in votes:
+        if vote.target.startswith(MESH_TARGET):
+            add_vote(metadata.setdefault("meshHeadings", []), "name",
+                     vote.target[len(MESH_TARGET):], vote.username, vote.value)
+        elif vote.target.startswith(EXPERIMENT_TARGET):
+            experiment, column, tag = vote.target[len(
+                EXPERIMENT_TARGET):].split(":", 2)
+            exp = by_id.get(int(experiment))
+            if exp is not None:
+                if not isinstance(exp.get(column), list):
+                    exp[column] = []
+                add_vote(exp[column], "tag", tag, vote.username, vote.value)
+        elif vote.target == SPACE_TARGET:
+            metadata.setdefault("space_subjects", {}).setdefault(
+                "radio_votes", []).append({
+                    "username": vote.username,
+                    "type": vote.value
+                })
+        elif vote.target == SUBJECTS_TARGET:
+            value = vote.value
+            try:
+                value = int(value)
+            except BaseException:
+                pass
+            metadata.setdefault("space_subjects", {}).setdefault(
+                "number_of_subjects", []).append({
+                    "username": vote.username,
+                    "value": value
+                })
+        elif vote.target == USER_TAG_TARGET:
+            metadata.setdefault("user_tags", {})[vote.username] = {
+                "tag_name": vote.value
             }
-        }
-    query = Articles.update(metadata=target).where(Articles.pmid == pmid)
-    query.execute()
 
 
 def get_number_of_articles():
-    """ Get the total number of articles in the database. """
+    """
+    Get the total number of articles in the database, from the counter
+    that a trigger on the articles table maintains.
+    """
 
+    try:
+        counters = list(Counters.select(Counters.value).where(
+            Counters.name == ARTICLES_COUNTER).execute())
+    except ProgrammingError:
+        # the "article-count" migration hasn't created the table
+        counters = []
+    if counters:
+        return counters[0].value
+    # the "article-count" migration hasn't been applied
     return Articles.select().wrapped_count()
 
 # BEGIN: add article functions
@@ -189,6 +243,8 @@ def add_pmid_article_to_database(article_id):
     """
 
     pmid = str(article_id)
+    # don't hold a database connection while waiting on PubMed and Neurosynth
+    release_connection()
     try:
         handle = efetch("pubmed", id=[pmid], rettype="medline", retmode="text")
     except BaseException:
@@ -203,11 +259,11 @@ def add_pmid_article_to_database(article_id):
     article_info["abstract"] = records.get("AB")
     article_info["DOI"] = getDOI(records.get("AID", []))
     article_info["experiments"] = []
-    article_info["metadata"] = str({"meshHeadings": []})
+    article_info["metadata"] = {"meshHeadings": []}
     article_info["reference"] = None
     identity = ""
     try:
-        locations_list = eval(
+        locations_list = json.loads(
             urllib.request.urlopen(
                 "http://neurosynth.org/api/studies/peaks/" +
                 str(pmid) +
@@ -244,12 +300,14 @@ def add_pmid_article_to_database(article_id):
     except BaseException:
         pass
 
-    Articles.create(abstract=article_info["abstract"],
-                    authors=article_info["authors"],
-                    doi=article_info["DOI"],
-                    experiments=str(article_info["experiments"]),
-                    pmid=article_info["PMID"],
-                    title=article_info["title"])
+    with conn.atomic():
+        Articles.create(abstract=article_info["abstract"],
+                        authors=article_info["authors"],
+                        doi=article_info["DOI"],
+                        pmid=article_info["PMID"],
+                        title=article_info["title"])
+        replace_experiments(pmid, article_info["experiments"])
+    invalidate_searches()
     return True
 
 
@@ -278,16 +336,13 @@ def clean_bulk_add(contents):
             article["authors"] = ",".join(article["authors"])
             if "doi" not in article:
                 article["doi"] = None
-            if "experiments" in article:
-                article["experiments"] = str(article["experiments"])
-            else:
-                article["experiments"] = str([])
+            if "experiments" not in article:
+                article["experiments"] = []
             if "meshHeadings" in article:
-                article["metadata"] = str(
-                    {"meshHeadings": article["meshHeadings"]})
+                article["metadata"] = {"meshHeadings": article["meshHeadings"]}
                 del article["meshHeadings"]
             else:
-                article["metadata"] = str({"meshHeadings": []})
+                article["metadata"] = {"meshHeadings": []}
             if "journal" in article and "year" in article:
                 article["reference"] = article["authors"] + \
                     "(" + str(article["year"]) + ") " + article["journal"]
@@ -318,76 +373,254 @@ def clean_bulk_add(contents):
 def add_bulk(papers, limit=100):  # papers is the entire formatted data set
     """ Add a list of article entries to our database. """
 
+    # experiments go in their own tables
+    rows = [{k: v for k, v in paper.items() if k != "experiments"}
+            for paper in papers]
     with conn.atomic():
-        for article in range(0, len(papers), limit):  # Inserts limit at a time
-            Articles.insert_many(papers[article:article + limit]).execute()
+        for article in range(0, len(rows), limit):  # Inserts limit at a time
+            Articles.insert_many(rows[article:article + limit]).execute()
+        for paper in papers:
+            replace_experiments(paper["pmid"], paper.get("experiments", []))
+    invalidate_searches()
+    send_post_save([paper["pmid"] for paper in papers], created=True)
 
 # BEGIN: table helper functions
 
 
+# the id of the first experiment table added to an article
+FIRST_EXPERIMENT_ID = 90000
+
+
+def experiment_at(pmid, exp, field=Experiments.uniqueid):
+    """
+    Return a subquery for a field of the table at index "exp" (zero-indexed)
+    of an article.
+    """
+
+    return Experiments.select(field).where(
+        Experiments.pmid == str(pmid)).order_by(
+        Experiments.position).offset(int(exp)).limit(1)
+
+
+def get_experiment(pmid, exp):
+    """ Return the Experiments row for the table at index "exp" of an article. """
+
+    return next(experiment_at(pmid, exp, Experiments).execute())
+
+
+def locations_of(pmid, exp):
+    """ Return a predicate for the locations of the table at index "exp". """
+
+    return (Peaks.pmid == str(pmid)) & (
+        Peaks.experiment << experiment_at(pmid, exp, Experiments.experiment))
+
+
+def location_at(pmid, exp, row):
+    """ Return a subquery for the uniqueid of a row of a table. """
+
+    return Peaks.select(Peaks.uniqueid).where(
+        locations_of(pmid, exp)).order_by(
+        Peaks.position).offset(int(row)).limit(1)
+
+
+def insert_position(model, scope, index):
+    """
+    Return a position that places a new row at "index" among the rows of
+    "model" that match "scope", in order of position. An index of -1, or
+    past the end, places it after the last row. Reads at most two rows.
+    """
+
+    query = model.select(model.position).where(scope)
+    if index >= 0:
+        neighbors = [r.position for r in query.order_by(
+            model.position).offset(max(index - 1, 0)).limit(2).execute()]
+        if index == 0 and neighbors:
+            return neighbors[0] - 1
+        if len(neighbors) == 2:
+            middle = (neighbors[0] + neighbors[1]) / 2
+            if neighbors[0] < middle < neighbors[1]:
+                return middle
+            # we've run out of precision between these two rows
+            renumber(model, scope)
+            return insert_position(model, scope, index)
+    last = list(query.order_by(model.position.desc()).limit(1).execute())
+    if last:
+        return last[0].position + 1
+    return 0
+
+
+def renumber(model, scope):
+    """ Space out the positions of the rows that match "scope". """
+
+    rows = model.select(model.uniqueid).where(
+        scope).order_by(model.position).execute()
+    with conn.atomic():
+        for i, row in enumerate(rows):
+            model.update(position=i).where(
+                model.uniqueid == row.uniqueid).execute()
+
+
+def next_experiment_id(pmid):
+    """ Return an unused experiment id for an article. """
+
+    greatest = Experiments.select(fn.MAX(Experiments.experiment)).where(
+        Experiments.pmid == str(pmid)).scalar()
+    if greatest is None:
+        return FIRST_EXPERIMENT_ID
+    return greatest + 1
+
+
+def location_values(location):
+    """
+    Return the Peaks columns for a location string, like "-26,54,14" or
+    "-26,54,14,3.2". The coordinates are null if it can't be parsed.
+    """
+
+    values = {
+        "location": str(location),
+        "x": None,
+        "y": None,
+        "z": None,
+        "stat": None
+    }
+    try:
+        coordinates = [float(v) for v in str(location).split(",")]
+    except BaseException:
+        return values
+    if len(coordinates) in (3, 4):
+        values["x"], values["y"], values["z"] = coordinates[:3]
+        if len(coordinates) == 4:
+            values["stat"] = coordinates[3]
+    return values
+
+
+def table_rows(pmid, experiments):
+    """
+    Return a tuple (experiment_rows, location_rows) with the Experiments and
+    Peaks rows for a list of experiments. Experiments without an id (or
+    with a duplicate id) are given one.
+    """
+
+    experiments = [e for e in experiments if isinstance(e, dict)]
+    ids = []
+    for exp in experiments:
+        try:
+            ids.append(int(exp["id"]))
+        except BaseException:
+            ids.append(None)
+    next_id = max([i for i in ids if i is not None] +
+                  [FIRST_EXPERIMENT_ID - 1]) + 1
+    experiment_rows = []
+    location_rows = []
+    seen = set()
+    for position, (exp, experiment) in enumerate(zip(experiments, ids)):
+        if experiment is None or experiment in seen:
+            experiment = next_id
+            next_id += 1
+        seen.add(experiment)
+        experiment_rows.append({
+            "pmid": str(pmid),
+            "experiment": experiment,
+            "position": position,
+            "document": {k: v for k, v in exp.items()
+                         if k not in ("id", "locations")}
+        })
+        for row, location in enumerate(exp.get("locations") or []):
+            values = location_values(location)
+            values.update({
+                "pmid": str(pmid),
+                "experiment": experiment,
+                "position": row
+            })
+            location_rows.append(values)
+    return (experiment_rows, location_rows)
+
+
+def get_experiments(pmid):
+    """
+    Return the experiment tables of an article as a list of dictionaries,
+    each with its "id" and "locations".
+    """
+
+    experiments = []
+    by_id = {}
+    for row in Experiments.select().where(
+            Experiments.pmid == str(pmid)).order_by(
+            Experiments.position).execute():
+        exp = dict(row.document or {})
+        exp["id"] = row.experiment
+        exp["locations"] = []
+        experiments.append(exp)
+        by_id[row.experiment] = exp
+    for peak in Peaks.select(Peaks.experiment, Peaks.location).where(
+            Peaks.pmid == str(pmid)).order_by(Peaks.position).execute():
+        if peak.experiment in by_id:
+            by_id[peak.experiment]["locations"].append(peak.location)
+    return experiments
+
+
+def get_voted_article(article):
+    """
+    Return a tuple (metadata, experiments) for an article, with its votes
+    folded in.
+    """
+
+    metadata = dict(article.metadata or {})
+    metadata.setdefault("meshHeadings", [])
+    experiments = get_experiments(article.pmid)
+    merge_votes(get_votes(article.pmid), metadata, experiments)
+    return (metadata, experiments)
+
+
 def delete_row(pmid, exp, row):
     """ Delete a row of coordinates from an experiment. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[exp]
-    locations = elem["locations"]
-    locations.pop(row)
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    Peaks.delete().where(
+        Peaks.uniqueid << location_at(pmid, exp, row)).execute()
+    invalidate_experiment_searches()
 
 
 def flag_table(pmid, exp):
     """ Flag a table as inaccurate. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[int(exp)]
-    if "flagged" in elem:
-        # toggle the flag if it exists
-        elem["flagged"] = 1 - elem["flagged"]
-    else:
-        elem["flagged"] = 1
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    # toggle the flag, treating a missing flag as 0
+    Experiments.update(document=SQL(
+        "COALESCE(document, '{}') || jsonb_build_object('flagged', "
+        "1 - COALESCE((document->>'flagged')::int, 0))")).where(
+        Experiments.uniqueid << experiment_at(pmid, exp)).execute()
+    invalidate_experiment_searches()
 
 
 def edit_table_title_caption(pmid, exp, title, caption):
     """ Edit the title and caption of a table. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[int(exp)]
-    elem["title"] = title
-    elem["caption"] = caption
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    Experiments.update(document=SQL(
+        "COALESCE(document, '{}') || %s",
+        Json({"title": title, "caption": caption}))).where(
+        Experiments.uniqueid << experiment_at(pmid, exp)).execute()
+    invalidate_experiment_searches()
 
 
 def split_table(pmid, exp, row):
     """ Split a coordinate table into two. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[exp]
-    locations = elem["locations"]
-    locations1 = locations[0:row]
-    locations2 = locations[row:]
-    elem["locations"] = locations1
-    highestID = int(max([exp["id"] for exp in experiments])) + 1
-    secondTable = {
-        "title": "",
-        "caption": "",
-        "locations": locations2,
-        "id": highestID
-    }
-    experiments.insert(exp + 1, secondTable)
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    with conn.atomic():
+        experiment = get_experiment(pmid, exp)
+        new_id = next_experiment_id(pmid)
+        Experiments.insert(
+            pmid=str(pmid),
+            experiment=new_id,
+            position=insert_position(
+                Experiments, Experiments.pmid == str(pmid), exp + 1),
+            document={"title": "", "caption": ""}).execute()
+        # move the rows from "row" on into the new table
+        moved = Peaks.select(Peaks.uniqueid).where(
+            Peaks.pmid == str(pmid),
+            Peaks.experiment == experiment.experiment).order_by(
+            Peaks.position).offset(int(row))
+        Peaks.update(experiment=new_id).where(
+            Peaks.uniqueid << moved).execute()
+    invalidate_experiment_searches()
 
 
 def add_coordinate_row(pmid, exp, coords, row_number=-1):
@@ -396,17 +629,19 @@ def add_coordinate_row(pmid, exp, coords, row_number=-1):
     Take a list of three or four coordinates.
     Take a row number. -1 will add to the end of the list. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[int(exp)]
-    row_list = ",".join([str(c) for c in coords])
-    if row_number == -1:
-        elem["locations"].append(row_list)
-    else:
-        elem["locations"].insert(row_number, row_list)
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    experiment = get_experiment(pmid, exp)
+    values = location_values(",".join([str(c) for c in coords]))
+    values.update({
+        "pmid": str(pmid),
+        "experiment": experiment.experiment,
+        "position": insert_position(
+            Peaks,
+            (Peaks.pmid == str(pmid)) & (
+                Peaks.experiment == experiment.experiment),
+            row_number)
+    })
+    Peaks.insert(**values).execute()
+    invalidate_experiment_searches()
 
 
 def update_coordinate_row(pmid, exp, coords, row_number):
@@ -414,65 +649,64 @@ def update_coordinate_row(pmid, exp, coords, row_number):
 
     Take a list of three or four coordinates. Take a row number. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
-    elem = experiments[int(exp)]
-    row_list = ",".join([str(c) for c in coords])
-    elem["locations"][row_number] = row_list
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    values = location_values(",".join([str(c) for c in coords]))
+    Peaks.update(**values).where(
+        Peaks.uniqueid << location_at(pmid, exp, row_number)).execute()
+    invalidate_experiment_searches()
 
 
 def add_table_through_text_box(pmid, values):
     """ Add an experiment table using a CSV-formatted string. """
 
-    target = next(get_article_object(pmid))
-    experiments = eval(target.experiments)
     values = values.replace(" ", "").split("\n")
-    secondTable = {"title": "", "caption": "", "locations": values,
-                   "id": (max([exp["id"] for exp in experiments]) + 1)}
-    experiments.insert(len(experiments), secondTable)
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    with conn.atomic():
+        experiment = next_experiment_id(pmid)
+        Experiments.insert(
+            pmid=str(pmid),
+            experiment=experiment,
+            position=insert_position(
+                Experiments, Experiments.pmid == str(pmid), -1),
+            document={"title": "", "caption": ""}).execute()
+        rows = []
+        for row, location in enumerate(values):
+            location = location_values(location)
+            location.update({
+                "pmid": str(pmid),
+                "experiment": experiment,
+                "position": row
+            })
+            rows.append(location)
+        if rows:
+            Peaks.insert_many(rows).execute()
+    invalidate_experiment_searches()
 
 
 def update_table_vote(tag_name, direction, table_num, pmid, column, username):
     """ Update the vote on an experiment tag for a given user. """
 
-    article_obj = Articles.select(
-        Articles.experiments).where(
-        Articles.pmid == pmid).execute()
-    article_obj = next(article_obj)
-    article_obj = eval(article_obj.experiments)
-
-    # get the table object
-    table_obj = article_obj[table_num]
-    if not table_obj.get(column):
-        table_obj[column] = []
-
-    update_vote_in_struct(
-        table_obj[column],
-        tag_name,
-        username,
-        direction,
-        "tag")
-
-    article_obj[table_num] = table_obj
-
-    query = Articles.update(
-        experiments=article_obj).where(
-        Articles.pmid == pmid)
-    query.execute()
+    conn.execute_sql(
+        TOGGLE_VOTE_SQL.format(
+            target=EXPERIMENT_TARGET_SQL, owner="username = %(username)s"), {
+            "pmid": str(pmid),
+            "index": int(table_num),
+            "target": column + ":" + tag_name,
+            "username": username,
+            "value": direction
+        })
 
 
-def replace_experiments(pmid, experiments):
-    """ Replace the experiments dict for a PMID. """
+def replace_experiments(pmid, experiments, limit=500):
+    """ Replace all of the experiment tables for a PMID. """
 
-    Articles.update(
-        experiments=experiments).where(
-        Articles.pmid == pmid).execute()
+    experiment_rows, location_rows = table_rows(pmid, experiments or [])
+    with conn.atomic():
+        Experiments.delete().where(Experiments.pmid == str(pmid)).execute()
+        Peaks.delete().where(Peaks.pmid == str(pmid)).execute()
+        for model, rows in ((Experiments, experiment_rows),
+                            (Peaks, location_rows)):
+            for i in range(0, len(rows), limit):
+                model.insert_many(rows[i:i + limit]).execute()
+    invalidate_experiment_searches()
 
 
 def replace_metadata(pmid, metadata):
@@ -480,11 +714,11 @@ def replace_metadata(pmid, metadata):
 
     Articles.update(metadata=metadata).where(
         Articles.pmid == str(pmid)).execute()
+    # the metadata has the MeSH headings, which [MH] searches match
+    invalidate_searches()
 
 
 def check_existence(pmid):
     """ Evaluates whether a PMID exists in our database. """
 
-    return Articles.select(
-        Articles.pmid).where(
-        Articles.pmid == str(pmid)).execute()
+    return article_exists(pmid)
@@ -1,23 +1,190 @@
 import json
+import os
+import threading
+import time
 import urllib.parse
 from abc import ABCMeta
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import partial
 
 import tornado
+import tornado.httpclient
 import tornado.web
-import requests
 from tornado.concurrent import run_on_executor
+from tornado.httputil import url_concat
 
+from metrics import request_metrics
 from user_account_helpers import *
 
-MAX_WORKERS = 16
 PMID_DESC = "The PMID of an article."
 GITHUB_ACCESS_TOKEN_DESC = "The user's GitHub API access token."
 EXPERIMENT_DESC = "The index of the experiment table to modify, zero-indexed."
 ROW_NUMBER_DESC = "The index of the row of coordinates to modify."
 API_KEY_DESC = "The user's Brainspell API key."
 DIRECTION_DESC = "The direction to vote in. Options are 'up' or 'down'."
+# set on responses to PUSH requests, so that the client's next reads see
+# its writes (see BaseHandler.mark_written)
+WROTE_COOKIE = "wrote"
+
+
+class MeteredExecutor(ThreadPoolExecutor):
+    """
+    A thread pool that counts the calls waiting for a thread (its queue
+    depth) and how long they waited, for the server stats endpoint.
+    """
+
+    def __init__(self, max_workers):
+        super(MeteredExecutor, self).__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        submitted = time.time()
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        def run():
+            waited = time.time() - submitted
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return super(MeteredExecutor, self).submit(run)
+
+    def stats(self):
+        """ Return the pool's size, queue depth, and wait times. """
+
+        with self.lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "running": self.running,
+                "completed": self.completed,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "max_wait_seconds": round(self.max_wait_seconds, 3)
+            }
+
+
+blocking_executor = MeteredExecutor(BLOCKING_WORKERS)
+
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    Call a function that blocks (e.g., on PubMed) on blocking_executor, and
+    return a Future for its result that a handler can await. Unlike
+    run_query, this doesn't take a thread from the pool that runs quick
+    database queries.
+    """
+
+    return on_query_executor(
+        lambda: fn(*args, **kwargs), executor=blocking_executor)
+
+
+def compile_validator(parameters):
+    """
+    Compile an endpoint's "parameters" dictionary into a function that
+    takes a request's arguments and an accessor for their values, and
+    returns the same {"success": ..., "args"/"description": ...} dictionary
+    that get_safe_arguments always has. Parameters are checked in order,
+    and the first problem is reported.
+    """
+
+    steps = []
+    for k, spec in parameters.items():
+        parse = spec["type"]
+        missing = {
+            "success": 0,
+            "description": "Missing required parameter: " + k
+        }
+        bad_input = {
+            "success": 0,
+            "description": "Bad input for argument (type " +
+            parse.__name__ + "): " + k
+        }
+        default = None
+        if "default" in spec:
+            default = partial(parse, spec["default"])
+            try:
+                value = default()
+                # parse immutable defaults once; mutable ones (e.g., a
+                # json.loads list) are parsed per request, so that no two
+                # requests share them
+                if isinstance(value, (str, int, float, bool, type(None))):
+                    default = (lambda value=value: value)
+            except BaseException:
+                pass
+        steps.append((k, parse, default, missing, bad_input))
+    expected = frozenset(parameters)
+
+    def validate(arguments_dict, accessor):
+        args = {}
+        given = 0
+        for k, parse, default, missing, bad_input in steps:
+            if k in arguments_dict:
+                given += 1
+                try:
+                    args[k] = parse(accessor(k))
+                except BaseException:
+                    return dict(bad_input)
+            elif default is None:
+                return dict(missing)
+            else:
+                args[k] = default()
+        # only look for the unexpected parameter if there is one
+        if given != len(arguments_dict):
+            for k in arguments_dict:
+                if k not in expected:
+                    return {
+                        "success": 0,
+                        "description": "Unexpected parameter: " + k
+                    }
+
+        return {
+            "success": 1,
+            "args": args
+        }
+
+    return validate
+
+
+def format_help(parameters):
+    """ Return the /help documentation for an endpoint's parameters. """
+
+    formatted_parameters = {}
+    for p in parameters:
+        formatted_parameters[p] = {}
+        if "default" not in parameters[p]:
+            formatted_parameters[p]["required"] = True
+        else:
+            formatted_parameters[p]["required"] = False
+            formatted_parameters[p]["default"] = parameters[p]["default"]
+        type_name = parameters[p]["type"].__name__
+        if type_name == "loads":  # account for loads function
+            type_name = "json"
+        formatted_parameters[p]["type"] = type_name
+        if "description" in parameters[p]:
+            formatted_parameters[p]["description"] = parameters[p]["description"]
+    return {
+        "success": 1,
+        "parameters": formatted_parameters
+    }
 
 
 class Endpoint(Enum):
@@ -96,28 +263,51 @@ class BaseHandler(tornado.web.RequestHandler):
     will be one additional required parameter: the "key" parameter,
     which is the user's API key. This key will be automatically validated
     before the "process" function is called, and it will be included in
-    the "args" dict.
+    the "args" dict, along with "principal": the Principal (userid and
+    username) of the user that the key belongs to.
     * Note: If the "key" parameter is specified for a PULL_API endpoint, and
     the key is invalid, then the invalid key will be replaced with the empty
     string "". A PUSH_API endpoint will never be called with an invalid key.
 
-    Asynchronous endpoints:
+    Blocking endpoints:
     If your endpoint is going to block the main thread for a reasonable
-    period of time, please make it asynchronous. It's as easy as putting the blocking
-    code in its own function, decorating it with run_on_executor, and treating
-    it as a generator.
+    period of time (e.g., it fetches from PubMed, or parses a large file),
+    set "blocking" to True and write "process" as a plain function. It will
+    be run on blocking_executor, a bounded pool of BLOCKING_WORKERS threads
+    (see models.py), so the I/O loop keeps serving other requests:
 
-    from tornado.concurrent import run_on_executor
+    blocking = True
 
-    @run_on_executor
-    def blocker(self):
+    def process(self, response, args):
         # blocking code here
         ...
+        return response
 
-    def process(self, response, args):
-        blocked_result = yield self.blocker()
+    A blocking "process" can query the database directly, but it mustn't
+    write to the handler, so it can't be combined with handle_finishing.
+    Call release_connection before it waits on the network, so that it
+    doesn't hold a database connection in the meantime.
+
+    If only part of an asynchronous endpoint blocks, await that part with
+    run_blocking instead:
+
+    async def process(self, response, args):
+        blocked_result = await run_blocking(blocker, args["pmid"])
+        ...
+
+    Database access:
+    Don't query the database on the I/O loop. Call the helper function with
+    run_query, which runs it on a thread with its own database connection,
+    and await the result:
+
+    async def process(self, response, args):
+        results = await run_query(formatted_search, args["q"], args["start"])
         ...
 
+    Reads that can tolerate a few seconds of replication lag (e.g.,
+    searches) can use self.read_query instead, which sends them to a
+    replica, if there is one, unless the client wrote recently.
+
     API versioning:
     By default, do not change the api_version variable unless there would be namespace conflicts, or if
     you're making different assumptions than api_version 1 (e.g., you're assuming the database looks a certain way).
@@ -144,46 +334,20 @@ class BaseHandler(tornado.web.RequestHandler):
     route = None
 
     handle_finishing = False
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    blocking = False
+    # compiled from "parameters" by AbstractEndpoint.register
+    validator = None
+    help_json = None
+    metric_labels = None
+    executor = blocking_executor
 
     api_version = 1
 
     def get_safe_arguments(self, arguments_dict, accessor):
         """ Enforce type safety; do not verify API key. """
 
-        args = {}
-        for k in self.parameters:
-            if k not in arguments_dict:
-                if "default" not in self.parameters[k]:
-                    return {
-                        "success": 0,
-                        "description": "Missing required parameter: " + k
-                    }
-                else:
-                    args[k] = self.parameters[k]["type"](
-                        self.parameters[k]["default"])
-            else:
-                try:
-                    args[k] = self.parameters[k]["type"](accessor(k))
-                except BaseException:
-                    return {
-                        "success": 0,
-                        "description": "Bad input for argument (type " +
-                        self.parameters[k]["type"].__name__ +
-                        "): " +
-                        k
-                    }
-        for k in arguments_dict:
-            if k not in self.parameters:
-                return {
-                    "success": 0,
-                    "description": "Unexpected parameter: " + k
-                }
-
-        return {
-            "success": 1,
-            "args": args
-        }
+        validator = self.validator or compile_validator(self.parameters)
+        return validator(arguments_dict, accessor)
 
     async def get(self):
         """
@@ -199,40 +363,33 @@ class BaseHandler(tornado.web.RequestHandler):
         # provide help documentation
         components = [x for x in self.request.path.split("/") if x]
         if len(components) >= 3 and components[len(components) - 1] == "help":
-            formatted_parameters = {}
-            for p in self.parameters:
-                formatted_parameters[p] = {}
-                if "default" not in self.parameters[p]:
-                    formatted_parameters[p]["required"] = True
-                else:
-                    formatted_parameters[p]["required"] = False
-                    formatted_parameters[p]["default"] = self.parameters[p]["default"]
-                type_name = self.parameters[p]["type"].__name__
-                if type_name == "loads":  # account for loads function
-                    type_name = "json"
-                formatted_parameters[p]["type"] = type_name
-                if "description" in self.parameters[p]:
-                    formatted_parameters[p]["description"] = self.parameters[p]["description"]
-            self.finish_async({
-                "success": 1,
-                "parameters": formatted_parameters
-            })
+            self.write(self.help_json or json.dumps(
+                format_help(self.parameters)))
         else:
             # type check arguments
             argsDict = self.get_safe_arguments(
                 self.request.arguments, self.get_argument)
             if argsDict["success"] == 1:
-                # validate API key
-                if "key" in argsDict["args"] and not valid_api_key(
-                        argsDict["args"]["key"]):
-                    # an invalid API key gets replaced with ""
-                    argsDict["args"]["key"] = ""
+                # validate API key, and look up its user once per request
+                if "key" in argsDict["args"]:
+                    principal = await run_query(
+                        get_principal, argsDict["args"]["key"])
+                    argsDict["args"]["principal"] = principal
+                    if principal is None:
+                        # an invalid API key gets replaced with ""
+                        argsDict["args"]["key"] = ""
 
                 # only allow PUSH API if valid API key
                 if self.endpoint_type == Endpoint.PULL_API or (
                         self.endpoint_type == Endpoint.PUSH_API and argsDict["args"]["key"] != ""):
                     response = {"success": 1}
-                    if not self.handle_finishing:
+                    if self.endpoint_type == Endpoint.PUSH_API:
+                        self.mark_written()
+                    if self.blocking:
+                        response = await run_blocking(
+                            self.process, response, argsDict["args"])
+                        self.finish_async(response)
+                    elif not self.handle_finishing:
                         response = await self.process(response, argsDict["args"])
                         self.finish_async(response)
                     else:
@@ -248,6 +405,18 @@ class BaseHandler(tornado.web.RequestHandler):
 
     post = get
 
+    def on_finish(self):
+        """
+        Return this request's database connection to the pool, and record
+        the request's latency if this is a JSON endpoint.
+        """
+
+        release_connection()
+        if self.metric_labels is not None:
+            request_metrics.observe(
+                self.metric_labels + (self.get_status(),),
+                self.request.request_time())
+
     def finish_async(self, response, status_set=False):
         """ Write the response dictionary, and finish this asynchronous call. """
 
@@ -352,6 +521,29 @@ class BaseHandler(tornado.web.RequestHandler):
             self.set_header('Access-Control-Allow-Origin', origin)
         self.set_header('Access-Control-Allow-Credentials', 'true')
 
+    def mark_written(self):
+        """
+        Tell the client that it wrote, with a cookie that lasts
+        REPLICA_LAG_WINDOW seconds, during which read_query sends its reads
+        to the primary. DatabaseRouter.mark_written does the same for every
+        client, but only in the process that served the write.
+        """
+
+        self.set_cookie(WROTE_COOKIE, "1",
+                        expires=time.time() + REPLICA_LAG_WINDOW,
+                        httponly=True)
+
+    def read_query(self, fn, *args, **kwargs):
+        """
+        Run a query with run_read_query, or on the primary with run_query
+        if the client wrote recently (see mark_written), so that the client
+        sees its own writes even if another process served them.
+        """
+
+        if self.get_cookie(WROTE_COOKIE):
+            return run_query(fn, *args, **kwargs)
+        return run_read_query(fn, *args, **kwargs)
+
     def abort(self, msg):
         """ Abort an API request with the given error message. """
         self.finish_async({
@@ -360,25 +552,37 @@ class BaseHandler(tornado.web.RequestHandler):
         })
         raise OSError(msg)
 
-    async def github_request(self, f, route, token, data=None):
-        """ Make a request to the GitHub API.
-        Take in a function from requests, a route, GitHub token, data. """
+    async def github_request(self, method, route, token, data=None):
+        """ Make a request to the GitHub API, without blocking the I/O loop.
+        Take in an HTTP method ("GET", "PUT", etc.), a route, GitHub token,
+        data. The data is sent as a JSON body, except for GET requests, which
+        can't have a body; their data is added to the query string. """
 
         if route[0] == "/":
             route = route[1:]
-        if data:
-            data = json.dumps(data)
-        result = f(
+        body = None
+        if method == "GET":
+            if data:
+                route = url_concat(route, data)
+        elif data:
+            body = json.dumps(data)
+        elif method in ("POST", "PUT", "PATCH"):
+            body = ""
+        # the shared client reuses its connections to GitHub between requests
+        result = await tornado.httpclient.AsyncHTTPClient().fetch(
             "https://api.github.com/{0}".format(route),
-            data=data,
+            method=method,
+            body=body,
             headers={
                 "Authorization": "token " + token
-            })
-        if result.status_code < 200 or result.status_code > 299:
+            },
+            user_agent="Brainspell",
+            raise_error=False)
+        if result.code < 200 or result.code > 299:
             self.abort(
                 "Failure with GitHub request: {0}. Status code: {1}".format(
-                    route, result.status_code))
-        return result.json()
+                    route, result.code))
+        return json.loads(result.body.decode("utf-8"))
 
 
 class AbstractEndpoint(metaclass=ABCMeta):
@@ -387,6 +591,7 @@ class AbstractEndpoint(metaclass=ABCMeta):
     NO_ENDPOINT_TYPE = "The class {0} does not indicate what type of endpoint it is (using the endpoint_type variable). Please reimplement the class to conform to this specification."
     NO_PROCESS_FUNCTION = "The class {0} does not override the \"process\" function. Please reimplement the class to conform to this specification."
     NO_PARAMETERS_SPECIFIED = "The class {0} does not specify its parameters. Please reimplement the class to conform to this specification."
+    BLOCKING_AND_HANDLE_FINISHING = "The class {0} is a blocking endpoint, so its \"process\" function runs off the I/O loop and can't finish the request itself. Please unset handle_finishing."
 
     def register(subclass):
         """
@@ -400,6 +605,9 @@ class AbstractEndpoint(metaclass=ABCMeta):
             subclass.__name__)
         assert subclass.parameters is not None, AbstractEndpoint.NO_PARAMETERS_SPECIFIED.format(
             subclass.__name__)
+        assert not (
+            subclass.blocking and subclass.handle_finishing), AbstractEndpoint.BLOCKING_AND_HANDLE_FINISHING.format(
+            subclass.__name__)
 
         for p in subclass.parameters:
             # autofill the description for known fields, if not already
@@ -422,3 +630,13 @@ class AbstractEndpoint(metaclass=ABCMeta):
                 "type": str,
                 "description": API_KEY_DESC
             }
+
+        # validate arguments and answer /help without reinterpreting
+        # "parameters" on every request
+        subclass.validator = staticmethod(
+            compile_validator(subclass.parameters))
+        subclass.help_json = json.dumps(format_help(subclass.parameters))
+        subclass.metric_labels = (
+            subclass.__name__.replace("EndpointHandler", ""),
+            subclass.api_version,
+            subclass.endpoint_type.name.lower())
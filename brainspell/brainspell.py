@@ -11,6 +11,10 @@ import tornado.web
 import base_handler
 import deploy
 import github_collections
+import metrics
+import models
+import search_helpers
+import search_index
 import user_interface
 from websockets import *
 
@@ -82,6 +86,7 @@ def make_app():
                                'static')}),
         (r"/deploy", deploy.DeployHandler),
         (r"/api-socket", EndpointWebSocket),
+        (r"/metrics", metrics.MetricsHandler),
     ] + getJSONEndpoints() + getUserInterfaceHandlers(), debug=debug, **settings)
 
 
@@ -114,8 +119,16 @@ if __name__ == "__main__":
 
     if not debug:
         http_server.bind(port_to_run)  # runs at localhost:5000 by default
+        metrics.clear_shared()
         http_server.start(0)
+        metrics.share_periodically()
     else:
         http_server.listen(port_to_run)
+    # after forking, so that every process has its own connection pool,
+    # index, and listener
+    models.connect_database()
+    models.check_replicas_periodically()
+    if search_helpers.SEARCH_ENGINE == "memory":
+        search_index.start()
     print("Running Brainspell at http://localhost:{0}...".format(port_to_run))
     tornado.ioloop.IOLoop.current().start()
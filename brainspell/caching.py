@@ -0,0 +1,93 @@
+# an in-process cache for expensive lookups
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe cache that evicts the least recently used entry
+    when it's full, and treats entries older than "ttl" seconds as misses.
+
+    Calling "invalidate" bumps a generation counter, which makes every
+    existing entry stale in O(1); stale entries are dropped as they're found.
+
+    Each process has its own cache, so writes made by another process are
+    only picked up once the TTL expires.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """ Return the cached value for a key, or the default. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, generation = entry
+            if generation != self.generation:
+                del self.entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return default
+            if expires < time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        """
+        Cache a value, evicting the least recently used entry if full. If
+        "generation" (the cache's generation when the value was computed) is
+        given, and the cache has been invalidated since, the value is stale,
+        so it isn't cached.
+        """
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (
+                value, time.time() + self.ttl, self.generation)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """ Make every entry currently in the cache stale. """
+
+        with self.lock:
+            self.generation += 1
+
+    def stats(self):
+        """ Return a dictionary of statistics, for sizing the cache. """
+
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,97 @@
+# functions for turning coordinates into brain maps
+
+import gzip
+import math
+
+import numpy as np
+
+# the MNI152 template at 2 mm; voxel (i, j, k) is centered at
+# (90 - 2i, 2j - 126, 2k - 72) mm
+MNI_SHAPE = (91, 109, 91)
+MNI_AFFINE = [
+    [-2, 0, 0, 90],
+    [0, 2, 0, -126],
+    [0, 0, 2, -72],
+    [0, 0, 0, 1]
+]
+VOXEL_SIZE = 2
+DEFAULT_FWHM = 10
+# the widest smoothing allowed; the kernel's length, and so the cost of
+# smoothing, grows with the FWHM
+MAX_FWHM = 30
+
+
+def coordinates_to_voxels(coordinates):
+    """
+    Map an (n, 3) array of MNI coordinates (in mm) to the indices of the
+    nearest voxels, dropping coordinates that fall outside of the grid.
+    """
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    inverse = np.linalg.inv(np.array(MNI_AFFINE, dtype=float))
+    voxels = coordinates.dot(inverse[:3, :3].T) + inverse[:3, 3]
+    voxels = np.rint(voxels).astype(int)
+    inside = np.all((voxels >= 0) & (voxels < MNI_SHAPE), axis=1)
+    return voxels[inside]
+
+
+def gaussian_kernel(fwhm):
+    """ Return a normalized 1-D Gaussian kernel, in voxels, for a FWHM in mm. """
+
+    sigma = fwhm / (2 * math.sqrt(2 * math.log(2))) / VOXEL_SIZE
+    radius = max(1, int(math.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def smooth(volume, kernel):
+    """
+    Convolve a volume with a 1-D kernel along each axis in turn, which is
+    equivalent to convolving with the separable 3-D kernel. Each pass is a
+    weighted sum of shifted copies of the volume, so there are no loops
+    over voxels.
+    """
+
+    radius = len(kernel) // 2
+    for axis in range(volume.ndim):
+        padding = [(0, 0)] * volume.ndim
+        padding[axis] = (radius, radius)
+        padded = np.pad(volume, padding, mode="constant")
+        length = volume.shape[axis]
+        smoothed = np.zeros_like(volume)
+        for offset, weight in enumerate(kernel):
+            smoothed += weight * np.take(
+                padded, np.arange(offset, offset + length), axis=axis)
+        volume = smoothed
+    return volume
+
+
+def density_map(coordinates, fwhm=DEFAULT_FWHM):
+    """
+    Return a float32 volume on the MNI 2 mm grid with the number of peaks
+    in each voxel, smoothed with a Gaussian of the given FWHM in mm (no
+    smoothing if the FWHM is 0).
+    """
+
+    voxels = coordinates_to_voxels(coordinates)
+    counts = np.bincount(
+        np.ravel_multi_index(voxels.T, MNI_SHAPE),
+        minlength=int(np.prod(MNI_SHAPE)))
+    volume = counts.reshape(MNI_SHAPE).astype(np.float32)
+    if fwhm > 0:
+        volume = smooth(volume, gaussian_kernel(fwhm).astype(np.float32))
+    return volume
+
+
+def encode_volume(volume, compress=True):
+    """
+    Serialize a volume as little-endian float32 values in C order (the last
+    axis varies fastest), gzipped unless "compress" is False. Most voxels
+    are zero, so compression shrinks a map by an order of magnitude.
+    """
+
+    data = np.ascontiguousarray(volume, dtype="<f4").tobytes()
+    if compress:
+        data = gzip.compress(data, 6)
+    return data
@@ -254,8 +254,9 @@ class CollectionsEndpointHandler(BaseHandler, torngithub.GithubMixin):
                     }
 
                 # get article information from each pmid from the database
+                summaries = get_article_summaries(pmids)
                 repo["contents"] = [parse_article_object(
-                    next(get_article_object(p))) for p in pmids]
+                    summaries[str(p)]) for p in pmids if str(p) in summaries]
 
                 collections_list.append(repo)
         response["collections"] = collections_list
@@ -3,22 +3,30 @@
 import brainspell
 from article_helpers import *
 from base_handler import *
+from density_helpers import *
 from search_helpers import *
 from user_account_helpers import *
 
 # For GitHub OAuth
-import requests
+import tornado.gen
+import tornado.httpclient
 import urllib.parse
 import os
 import hashlib
+import math
 
 import itertools
 
 REQ_DESC = "The fields to search through. 'x' is experiments, 'p' is PMID, 'r' is reference, and 't' is title + authors + abstract."
 START_DESC = "The offset of the articles to show; e.g., start = 10 would return results 11 - 20."
-PUT = requests.put
-GET = requests.get
-POST = requests.post
+CURSOR_DESC = "The next_cursor from a previous response, to continue where that page left off. Takes precedence over start."
+# the most calls that one /json/batch request can make
+MAX_BATCH_CALLS = 20
+# the largest radius (in mm) that a coactivation map can search within
+MAX_COACTIVATION_RADIUS = 20
+PUT = "PUT"
+GET = "GET"
+POST = "POST"
 
 assert "github_frontend_client_id" in os.environ \
     and "github_frontend_client_secret" in os.environ, \
@@ -45,6 +53,54 @@ class ListEndpointsEndpointHandler(BaseHandler):
         return response
 
 
+class ServerStatsEndpointHandler(BaseHandler):
+    """ Return statistics about the caches, the database connection pool,
+    and the blocking endpoints' thread pool in the process that serves this
+    request. Brainspell runs one process per core in production. """
+
+    parameters = {}
+
+    endpoint_type = Endpoint.PULL_API
+
+    async def process(self, response, args):
+        response["search_cache"] = search_cache.stats()
+        response["experiments_cache"] = experiments_cache.stats()
+        response["database"] = database_stats()
+        response["api_key_cache"] = api_key_cache.stats()
+        response["blocking_executor"] = blocking_executor.stats()
+        return response
+
+
+class BatchEndpointHandler(BaseHandler):
+    """ Make several API calls in one request, e.g., to load everything that
+    a page needs at once. The calls run concurrently, and their responses are
+    returned in the same order. """
+
+    parameters = {
+        "calls": {
+            "type": json.loads,
+            "description": "A JSON-serialized list of calls, each of the form {\"type\": endpoint name, \"payload\": arguments}, like a message to the WebSocket API. e.g., [{\"type\": \"article\", \"payload\": {\"pmid\": \"10022492\"}}]"
+        }
+    }
+
+    endpoint_type = Endpoint.PULL_API
+
+    async def process(self, response, args):
+        # websockets builds its endpoint registry from this module, so it
+        # can't be imported until this module has loaded
+        import websockets
+
+        calls = args["calls"]
+        if not isinstance(calls, list) or len(calls) > MAX_BATCH_CALLS:
+            response["success"] = 0
+            response["description"] = "Calls must be a list of at most {0} calls.".format(
+                MAX_BATCH_CALLS)
+            return response
+        response["responses"] = await tornado.gen.multi(
+            [websockets.dispatch(call, self) for call in calls])
+        return response
+
+
 # BEGIN: Authentication endpoints
 
 class GithubOauthProductionEndpointHandler(BaseHandler):
@@ -72,19 +128,19 @@ class GithubOauthProductionEndpointHandler(BaseHandler):
             "code": code
         }
 
-        # TODO: Make asynchronous, since this is blocking.
-        result = requests.post(
+        result = await tornado.httpclient.AsyncHTTPClient().fetch(
             "https://github.com:443/login/oauth/access_token",
-            data
-        )
-        params = urllib.parse.parse_qs(result.text)
+            method="POST",
+            body=urllib.parse.urlencode(data),
+            raise_error=False)
+        params = urllib.parse.parse_qs((result.body or b"").decode("utf-8"))
 
         try:
             response["github_token"] = params["access_token"][0]
             user = await self.github_request(GET, "user", params["access_token"][0])
             # idempotent operation to make sure GitHub user is in our
             # database
-            register_github_user(user)
+            await run_query(register_github_user, user)
             hasher = hashlib.sha1()
             hasher.update(str(user["id"]).encode('utf-8'))
             api_key = hasher.hexdigest()
@@ -167,7 +223,7 @@ class CreateCollectionEndpointHandler(BaseHandler):
 
         # Create the metadata.json file.
 
-        username = get_github_username_from_api_key(args["key"])
+        username = args["principal"].username
 
         collection_metadata = {
             "description": args["description"],
@@ -211,7 +267,7 @@ class GetCollectionInfoEndpointHandler(BaseHandler):
 
         collection_name = get_repo_name_from_collection(
             args['collection_name'])
-        user = get_github_username_from_api_key(args['key'])
+        user = args["principal"].username
         collection_values = await self.github_request(
             GET, "repos/{0}/{1}/contents/metadata.json".format(
                 user, collection_name), args["github_token"])
@@ -255,7 +311,7 @@ class AddToCollectionEndpointHandler(BaseHandler):
             itertools.chain(
                 *search_pmids.values())) + unmapped_pmids
         for pmid in all_pmids:
-            if check_existence(pmid).count == 0:
+            if not check_existence(pmid):
                 if not add_pmid_article_to_database(pmid):
                     failures.append(pmid)
         return failures
@@ -289,13 +345,15 @@ class AddToCollectionEndpointHandler(BaseHandler):
             response["success"] = 0
             response["description"] = "Dictionary mapping search strings to PMIDs is invalid."
             return response
-        failures = self.add_new_pmids(
+        # fetches any new articles from PubMed
+        failures = await run_blocking(
+            self.add_new_pmids,
             args['search_to_pmids'],
             args['unmapped_pmids'])
         if len(failures) > 0:
             response['failures'] = json.dumps(failures)
 
-        username = get_github_username_from_api_key(args["key"])
+        username = args["principal"].username
 
         # Get PMIDs that are already added.
         route = "repos/{0}/{1}/contents/metadata.json".format(
@@ -336,7 +394,8 @@ class AddToCollectionEndpointHandler(BaseHandler):
 
         # Update the local cache on collections additions
         if len(args['unmapped_pmids']) == 1:
-            add_unmapped_article_to_cached_collections(
+            await run_query(
+                add_unmapped_article_to_cached_collections,
                 args['key'], args['unmapped_pmids'][0], args['collection_name'])
 
         return response
@@ -374,7 +433,7 @@ class ToggleExclusionFromCollectionEndpointHandler(BaseHandler):
 
     async def process(self, response, args):
         # Add the excluded experiment to the file for this PMID.
-        user = get_github_username_from_api_key(args['key'])
+        user = args["principal"].username
 
         article_values = await get_or_create_pmid(
             self,
@@ -445,8 +504,8 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
         # Get all repositories owned by this user, and return the names that start with
         # brainspell-neo-collection.
         if args['cache']:
-            response["collections"] = get_brainspell_collections_from_api_key(
-                args['key'])
+            response["collections"] = await run_query(
+                get_brainspell_collections_from_api_key, args['key'])
             return response
 
         brainspell_repos = []
@@ -455,10 +514,9 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
         more_repos = True
 
         while more_repos:
-            repos_list = await BaseHandler.github_request(self, f=GET,
-                                                          route="user/repos?per_page=100&page={0}".format(page_number),
-                                                          token=args["github_token"],
-                                                          data={"affiliation": "owner"})
+            repos_list = await BaseHandler.github_request(self, method=GET,
+                                                          route="user/repos?affiliation=owner&per_page=100&page={0}".format(page_number),
+                                                          token=args["github_token"])
 
             if len(repos_list) == 0:
                 more_repos = False
@@ -488,6 +546,13 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
                                                         args["github_token"])
             repo_meta = decode_from_github(repo_req["content"])
 
+            # Fetch every article in the collection at once.
+            summaries = await run_query(
+                get_article_summaries,
+                list(itertools.chain(
+                    repo_meta["unmapped_pmids"],
+                    *repo_meta["search_to_pmids"].values())))
+
             # Convert PeeWee article object to dict
             def parse_article_object(article_object):
                 return {
@@ -500,10 +565,10 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
             unmapped_article_dicts = []
 
             for p in repo_meta["unmapped_pmids"]:
-                try:
-                    obj = next(get_article_object(p))
-                    unmapped_article_dicts.append(parse_article_object(obj))
-                except BaseException:
+                if str(p) in summaries:
+                    unmapped_article_dicts.append(
+                        parse_article_object(summaries[str(p)]))
+                else:
                     if "failed_to_fetch" not in response:
                         response["failed_to_fetch"] = []
                     response["failed_to_fetch"].append(p)
@@ -512,10 +577,10 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
             for k in repo_meta["search_to_pmids"]:
                 search_to_articles[k] = []
                 for p in repo_meta["search_to_pmids"][k]:
-                    try:
-                        obj = next(get_article_object(p))
-                        search_to_articles[k].append(parse_article_object(obj))
-                    except BaseException:
+                    if str(p) in summaries:
+                        search_to_articles[k].append(
+                            parse_article_object(summaries[str(p)]))
+                    else:
                         if "failed_to_fetch" not in response:
                             response["failed_to_fetch"] = []
                         response["failed_to_fetch"].append(p)
@@ -531,8 +596,7 @@ class GetUserCollectionsEndpointHandler(BaseHandler):
             user_collections.append(single_collection)
 
         response["collections"] = user_collections
-        # TODO: Potentially make db updates like these Async: peewee-async
-        cache_user_collections(args['key'], user_collections)
+        await run_query(cache_user_collections, args['key'], user_collections)
         return response
 
 
@@ -611,10 +675,10 @@ class EditGlobalArticleEndpointHandler(BaseHandler):
         # Not in database: coordinate_space, effect_type, contrast, key-value
         # pairs
 
-        article = next(get_article_object(args["pmid"]))
+        article = next(await run_query(get_article_object, args["pmid"]))
         await self.validate_experiments(args["experiments"])
 
-        metadata = json.loads(article.metadata)
+        metadata = article.metadata
         if metadata is None:
             # Gracefully handle null metadata.
             metadata = {}
@@ -623,10 +687,7 @@ class EditGlobalArticleEndpointHandler(BaseHandler):
             # Update num subjects on non-null entry
             metadata["nsubjects"] = args["subjects"]
 
-        experiments = json.loads(article.experiments)
-        if experiments is None:
-            # Gracefully handle null experiments.
-            experiments = []
+        experiments = await run_query(get_experiments, args["pmid"])
 
         # Map from experiment ID to index.
         mapping = {}
@@ -642,8 +703,8 @@ class EditGlobalArticleEndpointHandler(BaseHandler):
             for k in exp:
                 experiments[idx][k] = exp[k]
 
-        replace_experiments(args['pmid'], json.dumps(experiments))
-        replace_metadata(args['pmid'], json.dumps(metadata))
+        await run_query(replace_experiments, args['pmid'], experiments)
+        await run_query(replace_metadata, args['pmid'], metadata)
 
         return response
 
@@ -681,7 +742,7 @@ class EditLocalArticleEndpointHandler(BaseHandler):
     async def process(self, response, args):
         # See what fields are included in the edit_contents dictionary, and update each provided
         # field in the appropriate place, whether on GitHub or otherwise.
-        user = get_github_username_from_api_key(args['key'])
+        user = args["principal"].username
 
         article_values = await get_or_create_pmid(
             self,
@@ -764,7 +825,7 @@ class GetArticleFromCollectionEndpointHandler(BaseHandler):
     async def process(self, response, args):
         # Get the PMID file from the GitHub repository for this collection.
 
-        user = get_github_username_from_api_key(args['key'])
+        user = args["principal"].username
         collection_values = await get_or_create_pmid(
             self, user, args["collection_name"], args["pmid"], args["github_token"])
 
@@ -806,7 +867,7 @@ class AddKeyValuePairEndpointHandler(BaseHandler):
 
     async def process(self, response, args):
         # Edit the PMID file from the GitHub repository for this collection.
-        user = get_github_username_from_api_key(args['key'])
+        user = args["principal"].username
 
         article_values = await get_or_create_pmid(
             self,
@@ -869,6 +930,21 @@ class QueryEndpointHandler(BaseHandler):
             "type": str,
             "default": "t",
             "description": REQ_DESC
+        },
+        "cursor": {
+            "type": str,
+            "default": "",
+            "description": CURSOR_DESC
+        },
+        "count": {
+            "type": int,
+            "default": 0,
+            "description": "1 to include the total number of hits, 0 otherwise. Large counts are estimated, and flagged with count_approximate."
+        },
+        "rank": {
+            "type": int,
+            "default": 0,
+            "description": "1 to return the most relevant articles first, each with a score, 0 to return them in the order they were added. Ranked results are paged with start, not cursor."
         }
     }
 
@@ -876,7 +952,20 @@ class QueryEndpointHandler(BaseHandler):
 
     async def process(self, response, args):
         database_dict = {}
-        results = formatted_search(args["q"], args["start"], args["req"])
+        ranked = args["rank"] != 0
+        try:
+            after = decode_cursor(args["cursor"])
+        except BaseException:
+            response["success"] = 0
+            response["description"] = "Invalid cursor."
+            return response
+        if ranked:
+            results = await self.read_query(
+                ranked_search, args["q"], args["start"], args["req"])
+        else:
+            results = await self.read_query(
+                formatted_search, args["q"], args["start"], args["req"],
+                after=after)
         output_list = []
         for article in results:
             try:
@@ -884,6 +973,8 @@ class QueryEndpointHandler(BaseHandler):
                     "id": article.pmid,
                     "title": article.title,
                     "authors": article.authors}
+                if ranked:
+                    article_dict["score"] = float(article.score)
                 output_list.append(article_dict)
             except BaseException:
                 pass
@@ -896,13 +987,21 @@ class QueryEndpointHandler(BaseHandler):
             # articles returned instead
         else:
             response["start_index"] = args["start"]
+        response["next_cursor"] = None if ranked else next_cursor(
+            results, SEARCH_PAGE_SIZE)
+        if args["count"] != 0:
+            count, approximate = await self.read_query(
+                count_search_results, args["q"], args["req"])
+            response["count"] = count
+            response["count_approximate"] = int(approximate)
         return response
 
 
 class CoordinatesEndpointHandler(BaseHandler):
     """
     API endpoint to fetch coordinates from all articles that match a query.
-    Return 200 sets of coordinates at a time.
+    Return 200 sets of coordinates at a time. To fetch all of them in one
+    request, use /json/coordinates-export.
     """
 
     parameters = {
@@ -920,25 +1019,163 @@ class CoordinatesEndpointHandler(BaseHandler):
             "type": str,
             "default": "t",
             "description": REQ_DESC
+        },
+        "cursor": {
+            "type": str,
+            "default": "",
+            "description": CURSOR_DESC
         }
     }
 
     endpoint_type = Endpoint.PULL_API
 
     async def process(self, response, args):
-        results = formatted_search(args["q"], args["start"], args["req"], True)
+        try:
+            after = decode_cursor(args["cursor"])
+        except BaseException:
+            response["success"] = 0
+            response["description"] = "Invalid cursor."
+            return response
+        results = await self.read_query(
+            formatted_search, args["q"], args["start"], args["req"], True,
+            after)
         output_list = []
         for article in results:
-            try:
-                experiments = json.loads(article.experiments)
-                for c in experiments:  # get the coordinates from the experiments
-                    output_list.extend(c["locations"])
-            except BaseException:
-                pass
+            output_list.extend(article.locations)
         response["coordinates"] = output_list
+        response["next_cursor"] = next_cursor(results, COORDINATES_PAGE_SIZE)
         return response
 
 
+class CoordinatesExportEndpointHandler(BaseHandler):
+    """
+    Stream the coordinates of every article that matches a query, as
+    newline-delimited JSON with one experiment per line: e.g.,
+    {"pmid": "123", "experiment": 90000, "coordinates": ["-26,54,14"]}
+    """
+
+    parameters = {
+        "q": {
+            "type": str,
+            "default": "",
+            "description": "The search query to export the coordinates for."
+        },
+        "req": {
+            "type": str,
+            "default": "t",
+            "description": REQ_DESC
+        }
+    }
+
+    endpoint_type = Endpoint.PULL_API
+    handle_finishing = True
+
+    chunks = None
+    disconnected = False
+
+    async def process(self, response, args):
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.chunks = stream_coordinates(args["q"], args["req"])
+        try:
+            while not self.disconnected:
+                chunk = await run_query(next, self.chunks, None)
+                if chunk is None:
+                    break
+                for experiment in chunk:
+                    self.write(json.dumps(experiment) + "\n")
+                # send each chunk as it's read, rather than buffering the
+                # whole export
+                await self.flush()
+        finally:
+            self.close_export()
+        if not self.disconnected:
+            self.finish()
+
+    def close_export(self):
+        """ Close the export's cursor, and its database connection. """
+
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+    def on_connection_close(self):
+        # a thread may be reading the next chunk, and a generator can't be
+        # closed while it runs, so let process close it once that's done
+        self.disconnected = True
+        super(CoordinatesExportEndpointHandler, self).on_connection_close()
+
+    def on_finish(self):
+        self.close_export()
+        super(CoordinatesExportEndpointHandler, self).on_finish()
+
+
+class CoactivationMapEndpointHandler(BaseHandler):
+    """
+    Return a density map of the peaks that coactivate with a coordinate
+    (i.e., the peaks of every experiment that reports a peak near it), as a
+    binary volume on the MNI 2 mm grid. See density_helpers.encode_volume
+    for the format; the X-Volume-Shape and X-Volume-Affine headers describe
+    the grid.
+    """
+
+    parameters = {
+        "coordinate": {
+            "type": str,
+            "description": "An MNI coordinate in mm, of the form \"-26,54,14\"."
+        },
+        "radius": {
+            "type": float,
+            "default": 1,
+            "description": "How close (in mm) a peak must be to the coordinate for its experiment to count; at most {0}.".format(MAX_COACTIVATION_RADIUS)
+        },
+        "fwhm": {
+            "type": float,
+            "default": DEFAULT_FWHM,
+            "description": "The FWHM (in mm) of the Gaussian to smooth the map with, or 0 for raw counts; at most {0}.".format(MAX_FWHM)
+        }
+    }
+
+    endpoint_type = Endpoint.PULL_API
+    handle_finishing = True
+
+    async def process(self, response, args):
+        if not (math.isfinite(args["radius"]) and
+                0 <= args["radius"] <= MAX_COACTIVATION_RADIUS):
+            response["success"] = 0
+            response["description"] = "The radius must be between 0 and {0}.".format(
+                MAX_COACTIVATION_RADIUS)
+            self.finish_async(response)
+            return
+        if not (math.isfinite(args["fwhm"]) and
+                0 <= args["fwhm"] <= MAX_FWHM):
+            response["success"] = 0
+            response["description"] = "The FWHM must be between 0 and {0}.".format(
+                MAX_FWHM)
+            self.finish_async(response)
+            return
+        try:
+            peaks = await self.read_query(
+                coactivated_peaks, args["coordinate"], args["radius"])
+        except BaseException:
+            response["success"] = 0
+            response["description"] = "Invalid coordinate."
+            self.finish_async(response)
+            return
+        # smoothing and compressing a volume takes long enough to block the
+        # I/O loop, so do both on the blocking pool
+        volume = await run_blocking(
+            density_map, [(p.x, p.y, p.z) for p in peaks], args["fwhm"])
+        compress = "gzip" in self.request.headers.get("Accept-Encoding", "")
+        self.set_header("Content-Type", "application/octet-stream")
+        if compress:
+            self.set_header("Content-Encoding", "gzip")
+        self.set_header("X-Volume-Shape", ",".join(str(d) for d in MNI_SHAPE))
+        self.set_header("X-Volume-Affine", json.dumps(MNI_AFFINE))
+        self.set_header("X-Peak-Count", str(len(peaks)))
+        self.write(await run_blocking(encode_volume, volume, compress))
+        self.finish()
+
+
 class RandomQueryEndpointHandler(BaseHandler):
     """ Return five random articles (for use on Brainspell's front page) """
 
@@ -948,7 +1185,7 @@ class RandomQueryEndpointHandler(BaseHandler):
 
     async def process(self, response, args):
         database_dict = {}
-        results = random_search()
+        results = await self.read_query(random_search)
         output_list = []
         for article in results:
             try:
@@ -973,8 +1210,10 @@ class AddArticleFromPmidEndpointHandler(BaseHandler):
     }
 
     endpoint_type = Endpoint.PUSH_API
+    # fetches the article from PubMed
+    blocking = True
 
-    async def process(self, response, args):
+    def process(self, response, args):
         add_pmid_article_to_database(args["new_pmid"])
         return response
 
@@ -998,15 +1237,18 @@ class ArticleEndpointHandler(BaseHandler):
 
     async def process(self, response, args):
         try:
-            article = next(get_article_object(args["pmid"]))
+            # from the primary rather than a replica, so that curators see
+            # their own edits
+            article = next(await run_query(get_article_object, args["pmid"]))
             response["timestamp"] = article.timestamp
             response["abstract"] = article.abstract
             response["authors"] = article.authors
             response["doi"] = article.doi
-            response["experiments"] = article.experiments
-            response["metadata"] = article.metadata
-            if article.metadata is None:
-                response["metadata"] = str({"meshHeadings": []})
+            metadata, experiments = await run_query(get_voted_article, article)
+            # serialized, for clients that expect the strings that these
+            # columns used to hold
+            response["experiments"] = json.dumps(experiments)
+            response["metadata"] = json.dumps(metadata)
             response["neurosynthid"] = article.neurosynthid
             response["pmid"] = article.pmid
             response["reference"] = article.reference
@@ -1026,8 +1268,10 @@ class BulkAddEndpointHandler(BaseHandler):
     parameters = {}
 
     endpoint_type = Endpoint.PUSH_API
+    # parses and inserts a whole file of articles
+    blocking = True
 
-    async def process(self, response, args):
+    def process(self, response, args):
         # TODO: add better file parsing function
         try:
             file_body = self.request.files['articlesFile'][0]['body'].decode(
@@ -1062,7 +1306,7 @@ class SetArticleAuthorsEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        update_authors(args["pmid"], args["authors"])
+        await run_query(update_authors, args["pmid"], args["authors"])
         return response
 
 
@@ -1084,11 +1328,9 @@ class ToggleStereotaxicSpaceVoteEndpointHandler(BaseHandler):
     async def process(self, response, args):
         space = args["space"].lower()
         if space == "mni" or space == "talairach":
-            vote_stereotaxic_space(
-                args["pmid"],
-                args["space"],
-                get_github_username_from_api_key(
-                    args["key"]))
+            username = args["principal"].username
+            await run_query(
+                vote_stereotaxic_space, args["pmid"], args["space"], username)
         else:
             response["success"] = 0
             response["description"] = "Invalid value for 'space' parameter."
@@ -1111,11 +1353,9 @@ class NumberOfSubjectsVoteEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        vote_number_of_subjects(
-            args["pmid"],
-            args["subjects"],
-            get_github_username_from_api_key(
-                args["key"]))
+        username = args["principal"].username
+        await run_query(
+            vote_number_of_subjects, args["pmid"], args["subjects"], username)
         return response
 
 
@@ -1138,7 +1378,8 @@ class AddExperimentsTableViaTextEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        add_table_through_text_box(args["pmid"], args["values"])
+        await run_query(
+            add_table_through_text_box, args["pmid"], args["values"])
         return response
 
 
@@ -1161,8 +1402,10 @@ class ToggleUserVoteEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        username = get_github_username_from_api_key(args["key"])
-        toggle_vote(args["pmid"], args["topic"], username, args["direction"])
+        username = args["principal"].username
+        await run_query(
+            toggle_vote, args["pmid"], args["topic"], username,
+            args["direction"])
         return response
 
 # BEGIN: table API endpoints
@@ -1186,8 +1429,8 @@ class ToggleUserTagOnArticleEndpointHandler(BaseHandler):
     async def process(self, response, args):
         pmid = args["pmid"]
         user_tag = args["tag_name"]
-        username = get_github_username_from_api_key(args["key"])
-        toggle_user_tag(user_tag, pmid, username)
+        username = args["principal"].username
+        await run_query(toggle_user_tag, user_tag, pmid, username)
         return response
 
 
@@ -1216,16 +1459,17 @@ class UpdateTableVoteEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        username = get_github_username_from_api_key(args["key"])
+        username = args["principal"].username
         c = args["column"]
         if c != "T" and c != "B" and c != "C":
             response["success"] = 0
             response["description"] = "That is not a valid option for the column parameter."
         else:
-            update_table_vote(
+            await run_query(
+                update_table_vote,
                 args["tag_name"],
                 args["direction"],
-                args["table_num"],
+                args["experiment"],
                 args["pmid"],
                 c,
                 username)
@@ -1247,7 +1491,7 @@ class FlagTableEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        flag_table(args["pmid"], args["experiment"])
+        await run_query(flag_table, args["pmid"], args["experiment"])
         return response
 
 
@@ -1273,7 +1517,8 @@ class EditTableTitleCaptionEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        edit_table_title_caption(
+        await run_query(
+            edit_table_title_caption,
             args["pmid"],
             args["experiment"],
             args["title"],
@@ -1299,7 +1544,8 @@ class DeleteRowEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        delete_row(args["pmid"], args["experiment"], args["row"])
+        await run_query(
+            delete_row, args["pmid"], args["experiment"], args["row_number"])
         return response
 
 
@@ -1324,7 +1570,8 @@ class SplitTableEndpointHandler(BaseHandler):
     endpoint_type = Endpoint.PUSH_API
 
     async def process(self, response, args):
-        split_table(args["pmid"], args["experiment"], args["row"])
+        await run_query(
+            split_table, args["pmid"], args["experiment"], args["row_number"])
         return response
 
 
@@ -1352,7 +1599,8 @@ class UpdateRowEndpointHandler(BaseHandler):
     async def process(self, response, args):
         coords = args["coordinates"]
         if len(coords) == 3 or len(coords) == 4:
-            update_coordinate_row(
+            await run_query(
+                update_coordinate_row,
                 args["pmid"],
                 args["experiment"],
                 coords,
@@ -1389,7 +1637,8 @@ class AddRowEndpointHandler(BaseHandler):
     async def process(self, response, args):
         coords = args["coordinates"]
         if len(coords) == 3 or len(coords) == 4:
-            add_coordinate_row(
+            await run_query(
+                add_coordinate_row,
                 args["pmid"],
                 args["experiment"],
                 coords,
@@ -1413,15 +1662,16 @@ class GetOaPdfEndpointHandler(BaseHandler):
     handle_finishing = True
 
     async def get_pdf_bytes(self, url):
-        response = requests.get(url).content
-        return response
+        response = await tornado.httpclient.AsyncHTTPClient().fetch(url)
+        return response.body
 
     async def process(self, response, args):
         doi = args['doi']
         unpaywallURL = 'https://api.unpaywall.org/v2/{doi}?email=keshavan@berkeley.edu'.format(
             doi=doi)
-        req = requests.get(unpaywallURL)
-        data = req.json()
+        req = await tornado.httpclient.AsyncHTTPClient().fetch(
+            unpaywallURL, raise_error=False)
+        data = json.loads(req.body.decode("utf-8"))
         if data['best_oa_location']:
             try:
                 # get pdf
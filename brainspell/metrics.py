@@ -0,0 +1,180 @@
+"""
+Latency and throughput metrics for the JSON API, served at /metrics in the
+Prometheus text format.
+
+BaseHandler records every JSON API request when it finishes, labelled by
+endpoint, API version, endpoint type, and status code. Recording a request
+is a bisect and a few additions, so that it costs microseconds; the text is
+only built when /metrics is scraped.
+
+Brainspell runs one process per core in production, all on the same port,
+so a scrape reaches an arbitrary one of them. So that every scrape reports
+the whole server, each process saves its series to a file in METRICS_DIR
+every SHARE_INTERVAL seconds (see share_periodically), and /metrics adds up
+the files of every process. The totals can lag by up to SHARE_INTERVAL, and
+they start over when Brainspell restarts (as Prometheus expects).
+"""
+
+import glob
+import json
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+
+import tornado.ioloop
+import tornado.web
+
+# upper bounds of the latency histogram's buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+LABEL_NAMES = ("endpoint", "api_version", "endpoint_type", "status")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# where the processes share their series, and how often, in seconds
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(
+    tempfile.gettempdir(), "brainspell-metrics"))
+SHARE_INTERVAL = float(os.environ.get("METRICS_SHARE_INTERVAL", 5))
+
+
+def format_labels(names, values):
+    """ Format label values as {name="value",...}, escaped for Prometheus. """
+
+    return "{" + ",".join('{0}="{1}"'.format(
+        name, str(value).replace("\\", "\\\\").replace(
+            "\n", "\\n").replace('"', '\\"'))
+        for name, value in zip(names, values)) + "}"
+
+
+class RequestMetrics(object):
+    """
+    Count requests, and histogram their latencies, per combination of
+    labels. Each combination keeps a count per bucket (not cumulative, so
+    that recording only touches one of them) followed by the sum of the
+    latencies.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        """ Record one request's latency under a tuple of LABEL_NAMES. """
+
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * \
+                    (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += seconds
+
+    def snapshot(self):
+        """ Return a copy of every series, as a dictionary. """
+
+        with self.lock:
+            return {labels: list(counts)
+                    for labels, counts in self.series.items()}
+
+    def render(self, others=()):
+        """
+        Return every series in the Prometheus text format, added to the
+        snapshots of other processes, if any.
+        """
+
+        totals = self.snapshot()
+        for snapshot in others:
+            for labels, counts in snapshot.items():
+                if labels in totals:
+                    totals[labels] = [
+                        a + b for a, b in zip(totals[labels], counts)]
+                else:
+                    totals[labels] = counts
+        series = sorted(totals.items())
+        requests = [
+            "# HELP brainspell_requests_total JSON API requests served.",
+            "# TYPE brainspell_requests_total counter"]
+        durations = [
+            "# HELP brainspell_request_duration_seconds Time to serve JSON API requests.",
+            "# TYPE brainspell_request_duration_seconds histogram"]
+        for labels, counts in series:
+            formatted = format_labels(LABEL_NAMES, labels)
+            total = sum(counts[:-1])
+            requests.append(
+                "brainspell_requests_total{0} {1}".format(formatted, total))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                durations.append(
+                    "brainspell_request_duration_seconds_bucket{0} {1}".format(
+                        format_labels(LABEL_NAMES + ("le",), labels + (bound,)),
+                        cumulative))
+            durations.append("brainspell_request_duration_seconds_sum{0} {1}".format(
+                formatted, repr(counts[-1])))
+            durations.append(
+                "brainspell_request_duration_seconds_count{0} {1}".format(
+                    formatted, total))
+        return "\n".join(requests + durations) + "\n"
+
+
+request_metrics = RequestMetrics()
+# whether this process shares its series with the others
+sharing = False
+
+
+def clear_shared():
+    """
+    Delete the series that earlier runs saved. Call once before forking, so
+    that the totals start over with the server.
+    """
+
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        os.remove(path)
+
+
+def share():
+    """ Save this process's series for the other processes to read. """
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, "{0}.json".format(os.getpid()))
+    with open(path + ".tmp", "w") as f:
+        json.dump([[list(labels), counts] for labels, counts in
+                   request_metrics.snapshot().items()], f)
+    # replace the file in one step, so that readers never see half of it
+    os.replace(path + ".tmp", path)
+
+
+def share_periodically():
+    """ Share this process's series every SHARE_INTERVAL seconds. Call once
+    per process, after forking. """
+
+    global sharing
+    sharing = True
+    tornado.ioloop.PeriodicCallback(share, SHARE_INTERVAL * 1000).start()
+
+
+def shared_snapshots():
+    """ Return the saved series of every other process. """
+
+    own = "{0}.json".format(os.getpid())
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if os.path.basename(path) == own:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append({tuple(labels): counts
+                                  for labels, counts in json.load(f)})
+        except (OSError, ValueError):
+            pass  # the process's file was removed or replaced as we read
+    return snapshots
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Serve the server's request metrics, for Prometheus to scrape. """
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(request_metrics.render(
+            shared_snapshots() if sharing else ()))
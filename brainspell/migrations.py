@@ -0,0 +1,563 @@
+"""
+Schema migrations that PeeWee can't express on its own (triggers, GIN
+indexes, backfills). Every migration is idempotent, so it's always safe to rerun one,
+including after it was interrupted.
+
+To apply all migrations in order, run `python3 brainspell/migrations.py`.
+To apply specific migrations, pass their names; e.g.,
+`python3 brainspell/migrations.py full-text-search`.
+"""
+
+import argparse
+import ast
+import json
+
+from psycopg2.extras import Json
+
+from article_helpers import (ARTICLES_COUNTER, EXPERIMENT_TARGET,
+                             FIRST_EXPERIMENT_ID, MESH_TARGET, SPACE_TARGET,
+                             SUBJECTS_TARGET, USER_TAG_TARGET,
+                             replace_experiments)
+from models import *
+
+BATCH_SIZE = 1000
+# the JSONB columns of the articles table, and the value that replaces a
+# document that can't be repaired
+JSON_COLUMNS = (
+    ("experiments", []),
+    ("metadata", {"meshHeadings": []})
+)
+CDATA_PREFIX = "<![CDATA["
+CDATA_SUFFIX = "]]>"
+
+
+def run_in_batches(sql, batch_size=BATCH_SIZE):
+    """
+    Repeatedly execute an UPDATE that touches at most "batch_size" rows
+    (passed as its only parameter), until it no longer matches any rows.
+    Each batch commits on its own, so an interrupted run can be resumed.
+    """
+
+    total = 0
+    while True:
+        updated = conn.execute_sql(sql, (batch_size,)).rowcount
+        if updated <= 0:
+            return total
+        total += updated
+
+
+def full_text_search():
+    """
+    Add tsvector columns for the title, abstract, and authors of each
+    article, a trigger that keeps them current, and a GIN index on each.
+    """
+
+    for column in ("title_vector", "abstract_vector", "authors_vector"):
+        conn.execute_sql(
+            "ALTER TABLE articles ADD COLUMN IF NOT EXISTS {0} tsvector".format(column))
+
+    # authors are names, so they shouldn't be stemmed
+    conn.execute_sql("""
+        CREATE OR REPLACE FUNCTION articles_vectors_trigger() RETURNS trigger AS $$
+        BEGIN
+            NEW.title_vector := to_tsvector('english', coalesce(NEW.title, ''));
+            NEW.abstract_vector := to_tsvector('english', coalesce(NEW.abstract, ''));
+            NEW.authors_vector := to_tsvector('simple', coalesce(NEW.authors, ''));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""")
+    conn.execute_sql(
+        "DROP TRIGGER IF EXISTS articles_vectors_update ON articles")
+    conn.execute_sql("""
+        CREATE TRIGGER articles_vectors_update
+        BEFORE INSERT OR UPDATE OF title, abstract, authors ON articles
+        FOR EACH ROW EXECUTE PROCEDURE articles_vectors_trigger()""")
+
+    # touching the title fires the trigger for rows that predate it
+    run_in_batches("""
+        UPDATE articles SET title = title WHERE uniqueid IN (
+            SELECT uniqueid FROM articles WHERE title_vector IS NULL LIMIT %s)""")
+
+    for column in ("title_vector", "abstract_vector", "authors_vector"):
+        conn.execute_sql(
+            "CREATE INDEX IF NOT EXISTS articles_{0}_gin ON articles USING GIN ({0})".format(column))
+
+
+def peaks():
+    """
+    Create the Peaks table, with its (x, y, z) index. It's filled by the
+    experiment-tables migration.
+    """
+
+    Peaks.create_table(fail_silently=True)
+
+
+def parse_document(text, default):
+    """
+    Parse a document that was stored as JSON or as a Python literal (the
+    output of str()). Return a tuple (document, repaired): if the text can't
+    be parsed, or isn't the same type as "default", then "default" is
+    returned, and "repaired" is True.
+    """
+
+    text = text.strip()
+    # a remnant of the original database
+    if text.startswith(CDATA_PREFIX) and text.endswith(CDATA_SUFFIX):
+        text = text[len(CDATA_PREFIX):-len(CDATA_SUFFIX)].strip()
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            document = parse(text)
+        except BaseException:
+            continue
+        if isinstance(document, type(default)):
+            return (document, False)
+    return (default, True)
+
+
+def convert_to_jsonb(column, shadow, default):
+    """
+    Fill in the shadow column for every row whose source column hasn't been
+    converted yet, BATCH_SIZE rows at a time. Return the number of rows
+    converted and the number that had to be repaired.
+    """
+
+    converted = repaired = 0
+    while True:
+        rows = conn.execute_sql(
+            "SELECT uniqueid, {0} FROM articles WHERE {0} IS NOT NULL AND {1} IS NULL "
+            "ORDER BY uniqueid LIMIT %s".format(
+                column, shadow), (BATCH_SIZE,)).fetchall()
+        if not rows:
+            return (converted, repaired)
+        with conn.atomic():
+            for uniqueid, text in rows:
+                document, was_repaired = parse_document(text, default)
+                conn.execute_sql(
+                    "UPDATE articles SET {0} = %s WHERE uniqueid = %s".format(shadow),
+                    (Json(document), uniqueid))
+                converted += 1
+                repaired += was_repaired
+
+
+def column_type(table, column):
+    """ Return the data type of a column, or None if it doesn't exist. """
+
+    row = conn.execute_sql(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = %s AND column_name = %s",
+        (table, column)).fetchone()
+    return row[0] if row else None
+
+
+def jsonb():
+    """
+    Convert the experiments and metadata columns from strings to JSONB.
+
+    Each column is converted into a shadow column in batches, so an
+    interrupted run picks up where it left off. A trigger clears the shadow
+    value of any row whose source changes in the meantime, so that the row
+    gets converted again. Rows that can't be parsed are replaced with an
+    empty document, and counted. Once every row is converted, the shadow
+    column replaces the original under a table lock.
+    """
+
+    for column, default in JSON_COLUMNS:
+        # experiments may have been moved into their own tables already
+        if column_type("articles", column) in (None, "jsonb"):
+            continue
+        shadow = column + "_jsonb"
+        conn.execute_sql(
+            "ALTER TABLE articles ADD COLUMN IF NOT EXISTS {0} jsonb".format(shadow))
+        conn.execute_sql("""
+            CREATE OR REPLACE FUNCTION articles_{0}_reset() RETURNS trigger AS $$
+            BEGIN
+                NEW.{0} := NULL;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql""".format(shadow))
+        conn.execute_sql(
+            "DROP TRIGGER IF EXISTS articles_{0}_reset ON articles".format(shadow))
+        conn.execute_sql("""
+            CREATE TRIGGER articles_{0}_reset
+            BEFORE UPDATE OF {1} ON articles
+            FOR EACH ROW EXECUTE PROCEDURE articles_{0}_reset()""".format(shadow, column))
+
+        converted, repaired = convert_to_jsonb(column, shadow, default)
+        with conn.atomic():
+            conn.execute_sql("LOCK TABLE articles IN ACCESS EXCLUSIVE MODE")
+            # rows written since the last batch
+            final, final_repaired = convert_to_jsonb(column, shadow, default)
+            conn.execute_sql(
+                "DROP TRIGGER articles_{0}_reset ON articles".format(shadow))
+            conn.execute_sql(
+                "DROP FUNCTION articles_{0}_reset()".format(shadow))
+            conn.execute_sql(
+                "ALTER TABLE articles DROP COLUMN {0}".format(column))
+            conn.execute_sql(
+                "ALTER TABLE articles RENAME COLUMN {0} TO {1}".format(
+                    shadow, column))
+        print("Converted {0}: {1} rows, {2} repaired.".format(
+            column, converted + final, repaired + final_repaired))
+
+    # e.g., for finding articles by MeSH heading with @>
+    conn.execute_sql(
+        "CREATE INDEX IF NOT EXISTS articles_metadata_gin ON articles USING GIN (metadata jsonb_path_ops)")
+
+
+def move_experiments():
+    """
+    Move the experiments of every article that still has them into the
+    Experiments and Peaks tables, BATCH_SIZE articles at a time. Each
+    article's experiments column is cleared in the same transaction, which
+    marks it as moved. Return the number of articles moved.
+    """
+
+    moved = 0
+    while True:
+        rows = conn.execute_sql(
+            "SELECT uniqueid, pmid, experiments FROM articles "
+            "WHERE experiments IS NOT NULL ORDER BY uniqueid LIMIT %s",
+            (BATCH_SIZE,)).fetchall()
+        if not rows:
+            return moved
+        with conn.atomic():
+            for uniqueid, pmid, experiments in rows:
+                if isinstance(experiments, str):
+                    experiments = parse_document(experiments, [])[0]
+                if pmid is not None:
+                    replace_experiments(pmid, experiments)
+                conn.execute_sql(
+                    "UPDATE articles SET experiments = NULL WHERE uniqueid = %s", (uniqueid,))
+                moved += 1
+
+
+def experiment_tables():
+    """
+    Replace the experiments column of the articles table with the
+    Experiments and Peaks tables, which store one row per table and per
+    location, so that editing a single row doesn't rewrite the article.
+    """
+
+    Experiments.create_table(fail_silently=True)
+    Peaks.create_table(fail_silently=True)
+    # Peaks tables from the "peaks" migration predate these columns
+    conn.execute_sql(
+        "ALTER TABLE peaks ADD COLUMN IF NOT EXISTS location varchar(255)")
+    conn.execute_sql(
+        "ALTER TABLE peaks ADD COLUMN IF NOT EXISTS position double precision")
+    for column in ("x", "y", "z"):
+        conn.execute_sql(
+            "ALTER TABLE peaks ALTER COLUMN {0} DROP NOT NULL".format(column))
+    conn.execute_sql(
+        "CREATE INDEX IF NOT EXISTS peaks_pmid_experiment_position ON peaks (pmid, experiment, position)")
+
+    if column_type("articles", "experiments") is not None:
+        moved = move_experiments()
+        with conn.atomic():
+            conn.execute_sql("LOCK TABLE articles IN ACCESS EXCLUSIVE MODE")
+            # articles written since the last batch
+            moved += move_experiments()
+            conn.execute_sql("ALTER TABLE articles DROP COLUMN experiments")
+        print("Moved the experiments of {0} articles.".format(moved))
+
+    orphaned = fix_orphaned_peaks()
+    if orphaned:
+        print("Gave {0} peaks without an experiment their own tables.".format(
+            orphaned))
+    conn.execute_sql("ALTER TABLE peaks ALTER COLUMN experiment SET NOT NULL")
+
+
+def fix_orphaned_peaks():
+    """
+    Give the peaks that the "peaks" migration stored with a NULL experiment
+    (those of experiments without an id) experiment tables of their own,
+    and return how many there were. Moving an article's experiments rewrites
+    its peaks with real ids, so these are only left for articles that
+    weren't moved.
+
+    That migration wrote each article's peaks in the order of its tables,
+    so each run of orphaned peaks (in uniqueid order) is taken to be one
+    experiment; a run also splits where the position stops increasing.
+    Each experiment gets its own id, after the greatest in Experiments or
+    Peaks for its article (as in table_rows), and an Experiments row after
+    the article's other tables.
+    """
+
+    with conn.atomic():
+        conn.execute_sql("""
+            CREATE TEMPORARY TABLE orphaned_peaks ON COMMIT DROP AS
+            WITH ordered AS (
+                SELECT uniqueid, pmid, experiment, position,
+                    lag(experiment IS NULL) OVER w AS follows_orphan,
+                    lag(position) OVER w AS previous_position
+                FROM peaks WINDOW w AS (PARTITION BY pmid ORDER BY uniqueid)
+            ), grouped AS (
+                SELECT uniqueid, pmid, position, sum((
+                    follows_orphan IS NOT TRUE OR
+                    position <= previous_position)::int) OVER (
+                    PARTITION BY pmid ORDER BY uniqueid) - 1 AS n
+                FROM ordered WHERE experiment IS NULL
+            )
+            SELECT grouped.uniqueid, grouped.pmid,
+                GREATEST(ids.experiment + 1, %s) + grouped.n AS experiment,
+                COALESCE(tables.position + 1, 0) + grouped.n AS table_position,
+                COALESCE(grouped.position, row_number() OVER (
+                    PARTITION BY grouped.pmid, grouped.n
+                    ORDER BY grouped.uniqueid) - 1) AS position
+            FROM grouped
+            LEFT JOIN (
+                SELECT pmid, max(experiment) AS experiment FROM (
+                    SELECT pmid, experiment FROM peaks
+                    UNION ALL SELECT pmid, experiment FROM experiments) used
+                GROUP BY pmid) ids ON ids.pmid = grouped.pmid
+            LEFT JOIN (
+                SELECT pmid, max(position) AS position FROM experiments
+                GROUP BY pmid) tables ON tables.pmid = grouped.pmid""",
+                         (FIRST_EXPERIMENT_ID,))
+        conn.execute_sql("""
+            INSERT INTO experiments (pmid, experiment, position, document)
+            SELECT DISTINCT pmid, experiment, table_position, %s
+            FROM orphaned_peaks""", (Json({"title": "", "caption": ""}),))
+        return conn.execute_sql("""
+            UPDATE peaks
+            SET experiment = orphaned_peaks.experiment,
+                position = orphaned_peaks.position
+            FROM orphaned_peaks
+            WHERE peaks.uniqueid = orphaned_peaks.uniqueid""").rowcount
+
+
+def tag_votes(entries, target):
+    """
+    Remove the votes from a list of tags in the old voting structure
+    ([{..., "vote": {"up": [...], "down": [...]}}]), and return them as
+    (target, username, value) tuples. "target" is called with each tag.
+    """
+
+    found = []
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not isinstance(
+                entry.get("vote"), dict):
+            continue
+        vote = entry.pop("vote")
+        for direction in ("up", "down"):
+            for voter in vote.get(direction) or []:
+                if isinstance(voter, dict) and voter.get("username"):
+                    found.append(
+                        (target(entry), voter["username"], direction))
+    return found
+
+
+def legacy_votes(metadata, documents):
+    """
+    Remove the votes from an article's metadata and its experiment
+    documents (a dictionary from experiment id to document), and return
+    them as (target, username, value) tuples. Modifies both.
+    """
+
+    found = tag_votes(metadata.get("meshHeadings"),
+                      lambda entry: MESH_TARGET + str(entry.get("name")))
+    space_subjects = metadata.pop("space_subjects", None) or {}
+    for vote in space_subjects.get("radio_votes") or []:
+        found.append((SPACE_TARGET, vote.get("username"), vote.get("type")))
+    for vote in space_subjects.get("number_of_subjects") or []:
+        found.append((SUBJECTS_TARGET, vote.get("username"),
+                      str(vote.get("value"))))
+    user_tags = metadata.pop("user_tags", None) or {}
+    for username, tag in user_tags.items():
+        if isinstance(tag, dict):
+            found.append((USER_TAG_TARGET, username, tag.get("tag_name")))
+    for experiment, document in documents.items():
+        for column, entries in document.items():
+            found.extend(tag_votes(
+                entries,
+                lambda entry: "{0}{1}:{2}:{3}".format(
+                    EXPERIMENT_TARGET, experiment, column, entry.get("tag"))))
+    return [vote for vote in found if vote[1]]
+
+
+def votes():
+    """
+    Move the votes out of the metadata and experiment documents of every
+    article into the Votes table, BATCH_SIZE articles at a time, so that
+    a vote is one INSERT or DELETE instead of a rewrite of the article.
+    """
+
+    Votes.create_table(fail_silently=True)
+    moved = 0
+    last = 0
+    while True:
+        with conn.atomic():
+            rows = conn.execute_sql(
+                "SELECT uniqueid, pmid, metadata FROM articles "
+                "WHERE uniqueid > %s ORDER BY uniqueid LIMIT %s FOR UPDATE",
+                (last, BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            for uniqueid, pmid, metadata in rows:
+                documents = {}
+                for experiment, document in conn.execute_sql(
+                        "SELECT experiment, document FROM experiments "
+                        "WHERE pmid = %s FOR UPDATE", (pmid,)).fetchall():
+                    documents[experiment] = document or {}
+                metadata = metadata or {}
+                article_votes = legacy_votes(metadata, documents)
+                if not article_votes:
+                    continue
+                for target, username, value in article_votes:
+                    conn.execute_sql(
+                        "INSERT INTO votes (pmid, target, username, value) "
+                        "VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                        (pmid, target, username, value))
+                conn.execute_sql(
+                    "UPDATE articles SET metadata = %s WHERE uniqueid = %s",
+                    (Json(metadata), uniqueid))
+                for experiment, document in documents.items():
+                    conn.execute_sql(
+                        "UPDATE experiments SET document = %s "
+                        "WHERE pmid = %s AND experiment = %s",
+                        (Json(document), pmid, experiment))
+                moved += len(article_votes)
+    print("Moved {0} votes.".format(moved))
+
+
+def article_summaries():
+    """
+    Create the ArticleSummaries table, a trigger on articles that keeps it
+    current, and fill it in for existing articles.
+    """
+
+    ArticleSummaries.create_table(fail_silently=True)
+    conn.execute_sql("""
+        CREATE OR REPLACE FUNCTION article_summaries_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM article_summaries WHERE uniqueid = OLD.uniqueid;
+                RETURN OLD;
+            END IF;
+            INSERT INTO article_summaries (uniqueid, pmid, title, authors, reference)
+            VALUES (NEW.uniqueid, NEW.pmid, NEW.title, NEW.authors, NEW.reference)
+            ON CONFLICT (uniqueid) DO UPDATE SET pmid = EXCLUDED.pmid,
+                title = EXCLUDED.title, authors = EXCLUDED.authors,
+                reference = EXCLUDED.reference;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""")
+    conn.execute_sql(
+        "DROP TRIGGER IF EXISTS article_summaries_update ON articles")
+    conn.execute_sql("""
+        CREATE TRIGGER article_summaries_update
+        AFTER INSERT OR DELETE OR UPDATE OF pmid, title, authors, reference
+        ON articles FOR EACH ROW EXECUTE PROCEDURE article_summaries_trigger()""")
+
+    # the trigger covers writes from now on, so copy the rows that predate it
+    run_in_batches("""
+        INSERT INTO article_summaries (uniqueid, pmid, title, authors, reference)
+        SELECT uniqueid, pmid, title, authors, reference FROM articles
+        WHERE NOT EXISTS (SELECT 1 FROM article_summaries
+                          WHERE article_summaries.uniqueid = articles.uniqueid)
+        LIMIT %s
+        ON CONFLICT (uniqueid) DO NOTHING""")
+
+
+def article_count():
+    """
+    Count the articles into the Counters table, and add triggers that keep
+    the count current as articles are added and deleted. The triggers run
+    once per statement, so that adding a batch of articles updates the
+    counter once rather than once per article. Rerunning this recounts them.
+    """
+
+    Counters.create_table(fail_silently=True)
+    conn.execute_sql("""
+        CREATE OR REPLACE FUNCTION articles_count_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE counters SET value = value + (SELECT count(*) FROM added)
+                WHERE name = TG_ARGV[0];
+            ELSE
+                UPDATE counters SET value = value - (SELECT count(*) FROM removed)
+                WHERE name = TG_ARGV[0];
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""")
+    with conn.atomic():
+        # block writes to articles while they're counted, so that none is
+        # missed or counted twice
+        conn.execute_sql("LOCK TABLE articles IN SHARE MODE")
+        # the per-row trigger that earlier versions of this migration added
+        conn.execute_sql(
+            "DROP TRIGGER IF EXISTS articles_count_update ON articles")
+        # a trigger with a transition table (Postgres 10 and later) can only
+        # fire on one event
+        conn.execute_sql(
+            "DROP TRIGGER IF EXISTS articles_count_insert ON articles")
+        conn.execute_sql("""
+            CREATE TRIGGER articles_count_insert
+            AFTER INSERT ON articles REFERENCING NEW TABLE AS added
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE articles_count_trigger(%s)""", (ARTICLES_COUNTER,))
+        conn.execute_sql(
+            "DROP TRIGGER IF EXISTS articles_count_delete ON articles")
+        conn.execute_sql("""
+            CREATE TRIGGER articles_count_delete
+            AFTER DELETE ON articles REFERENCING OLD TABLE AS removed
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE articles_count_trigger(%s)""", (ARTICLES_COUNTER,))
+        conn.execute_sql("""
+            INSERT INTO counters (name, value)
+            SELECT %s, count(*) FROM articles
+            ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value""",
+                         (ARTICLES_COUNTER,))
+
+
+def api_key_index():
+    """
+    Add a unique index on the API keys of users (the password column). If
+    some keys are shared, the users who share them are listed (by userid,
+    since the keys are credentials), and the index isn't unique.
+    """
+
+    duplicates = conn.execute_sql("""
+        SELECT array_agg(userid ORDER BY userid) FROM users
+        WHERE password IS NOT NULL
+        GROUP BY password HAVING count(*) > 1""").fetchall()
+    if not duplicates:
+        conn.execute_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_password ON users (password)")
+        return
+    for (userids,) in duplicates:
+        print("Users {0} share an API key.".format(
+            ", ".join(str(u) for u in userids)))
+    conn.execute_sql(
+        "CREATE INDEX IF NOT EXISTS users_password ON users (password)")
+
+
+MIGRATIONS = [
+    ("full-text-search", full_text_search),
+    ("peaks", peaks),
+    ("jsonb", jsonb),
+    ("experiment-tables", experiment_tables),
+    ("votes", votes),
+    ("article-summaries", article_summaries),
+    ("article-count", article_count),
+    ("api-key-index", api_key_index),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply Brainspell's database migrations.")
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="the migrations to apply (default: all, in order)",
+        default=[name for name, migration in MIGRATIONS])
+    args = parser.parse_args()
+    migrations = dict(MIGRATIONS)
+    for name in args.names:
+        assert name in migrations, "Unknown migration: " + name
+        print("Applying {0}...".format(name))
+        migrations[name]()
+    print("Done.")
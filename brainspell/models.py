@@ -1,15 +1,25 @@
 # contains PeeWee database models (our ORM)
 
+import itertools
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from urllib.parse import urlparse
 
 import peewee
 import playhouse
 import psycopg2
-from peewee import CharField, DateTimeField, IntegerField
+import psycopg2.extensions
+from peewee import (BigIntegerField, CharField, DateTimeField, DoubleField,
+                    FloatField, IntegerField, InterfaceError,
+                    OperationalError, Proxy)
 from playhouse import signals
+from playhouse.pool import PooledPostgresqlExtDatabase
 from playhouse.postgres_ext import *
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import PeriodicCallback
 
 # in case no DATABASE_URL is specified, default to Heroku
 url = urlparse(
@@ -21,20 +31,387 @@ if "DATABASE_URL" in os.environ:
 if "HEROKU_DB" in os.environ:  # for Heroku to work
     url = urlparse(os.environ["HEROKU_DB"])
 
-config = dict(
-    database=url.path[1:],
-    user=url.username,
-    password=url.password,
-    host=url.hostname,
-    port=url.port,
-    sslmode='require'
-)
 
-conn = PostgresqlExtDatabase(
-    autocommit=True,
-    autorollback=True,
-    register_hstore=False,
-    **config)
+def database_config(url):
+    """ Return the connection parameters for a parsed postgres:// URL. """
+
+    return dict(
+        database=url.path[1:],
+        user=url.username,
+        password=url.password,
+        host=url.hostname,
+        port=url.port,
+        sslmode='require'
+    )
+
+
+config = database_config(url)
+# optional read-only replicas of the database, as a comma-separated list of
+# URLs (see run_read_query)
+replica_configs = [
+    database_config(urlparse(replica_url.strip()))
+    for replica_url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    if replica_url.strip()]
+
+# the most connections that each process may have checked out at once, how
+# many seconds to wait for one when they're all in use, and how many seconds
+# a connection is kept before it's closed and replaced
+MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 20))
+# how many of those connections are set aside for exports, which each hold
+# a connection of their own for as long as they stream (see
+# export_connection); the pool gets the rest
+EXPORT_CONNECTIONS = max(1, min(
+    int(os.environ.get("DB_EXPORT_CONNECTIONS", 2)), MAX_CONNECTIONS // 4))
+POOL_CONNECTIONS = MAX_CONNECTIONS - EXPORT_CONNECTIONS
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+STALE_TIMEOUT = int(os.environ.get("DB_STALE_TIMEOUT", 300))
+# how often each process checks that the replicas are reachable, in seconds
+HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", 30))
+# after a write, how long reads stay on the primary, in seconds; should be
+# longer than the replicas usually lag behind
+REPLICA_LAG_WINDOW = float(os.environ.get("DB_REPLICA_LAG_WINDOW", 10))
+
+
+class PooledDatabase(PooledPostgresqlExtDatabase):
+    """
+    A connection pool that waits up to "pool_timeout" seconds for a
+    connection when "max_connections" are checked out, rather than failing
+    immediately, and counts how long it waits.
+
+    Each thread checks out a connection the first time that it queries, and
+    returns it with release_connection.
+    """
+
+    def __init__(self, *args, pool_timeout=POOL_TIMEOUT, **kwargs):
+        self.pool_timeout = pool_timeout
+        self.slots = threading.Condition()
+        # threads that are opening a connection, but haven't checked it out
+        self.reserved = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        super(PooledDatabase, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        started = time.time()
+        with self.slots:
+            waited = False
+            while self.max_connections and len(
+                    self._in_use) + self.reserved >= self.max_connections:
+                remaining = started + self.pool_timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise OperationalError(
+                        "Timed out waiting for a database connection.")
+                waited = True
+                self.slots.wait(remaining)
+            self.reserved += 1
+            wait = time.time() - started
+            self.checkouts += 1
+            self.waits += waited
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        try:
+            super(PooledDatabase, self).connect()
+        finally:
+            with self.slots:
+                self.reserved -= 1
+
+    def _close(self, conn, close_conn=False):
+        super(PooledDatabase, self)._close(conn, close_conn)
+        with self.slots:
+            self.slots.notify()
+
+    def stats(self):
+        """ Return a dictionary of statistics, for sizing the pool. """
+
+        with self.slots:
+            return {
+                "max_connections": self.max_connections,
+                "in_use": len(self._in_use),
+                "idle": len(self._connections),
+                "stale_timeout": self.stale_timeout,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+                "timeouts": self.timeouts
+            }
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    A psycopg2 connection that remembers which statements have been
+    PREPAREd on it, since prepared statements only last as long as the
+    session that prepared them (see prepared_queries.py).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def make_database(database_config):
+    """ Create a connection pool for this process. """
+
+    database = PooledDatabase(
+        connection_factory=PreparingConnection,
+        max_connections=POOL_CONNECTIONS,
+        stale_timeout=STALE_TIMEOUT,
+        autocommit=True,
+        autorollback=True,
+        register_hstore=False,
+        **database_config)
+    database.config = database_config
+    return database
+
+
+class DatabaseRouter(object):
+    """
+    Send each thread's queries to the primary database, or, inside "use",
+    to a replica. Replicas take turns, skipping the ones that failed their
+    last health check.
+    """
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+        self.healthy = set(replicas)
+        self.turns = itertools.count()
+        self.local = threading.local()
+        self.written = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.current(), attr)
+
+    def current(self):
+        """ Return the database that this thread's queries go to. """
+
+        return getattr(self.local, "database", None) or self.primary
+
+    def databases(self):
+        return [self.primary] + self.replicas
+
+    def choose_replica(self):
+        """
+        Return the next healthy replica, or None if there isn't one, or if
+        this process wrote recently (see mark_written).
+        """
+
+        if time.time() - self.written < REPLICA_LAG_WINDOW:
+            return None
+        healthy = [r for r in self.replicas if r in self.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self.turns) % len(healthy)]
+
+    def mark_written(self):
+        """
+        Send reads to the primary for the next REPLICA_LAG_WINDOW seconds,
+        so that they see a write that the replicas may not have yet. This
+        only affects this process; BaseHandler.mark_written covers the
+        client that wrote, whichever process serves it next.
+        """
+
+        self.written = time.time()
+
+    @contextmanager
+    def use(self, database):
+        """ Send this thread's queries to a database, within a block. """
+
+        previous = getattr(self.local, "database", None)
+        self.local.database = database
+        try:
+            yield
+        finally:
+            self.local.database = previous
+
+    def check_replicas(self):
+        """ Try a query on each replica, and record which ones work. """
+
+        for replica in self.replicas:
+            try:
+                replica.execute_sql("SELECT 1")
+                self.healthy.add(replica)
+            except BaseException:
+                self.healthy.discard(replica)
+            finally:
+                if not replica.is_closed():
+                    replica.close()
+
+    def stats(self):
+        """ Return the statistics of the primary's pool, and each replica's. """
+
+        stats = self.primary.stats()
+        stats["replicas"] = [dict(
+            replica.stats(),
+            host=replica.config["host"],
+            healthy=int(replica in self.healthy))
+            for replica in self.replicas]
+        return stats
+
+
+def make_router():
+    return DatabaseRouter(
+        make_database(config),
+        [make_database(replica) for replica in replica_configs])
+
+
+# the models use whichever router was created last in this process
+conn = Proxy()
+conn.initialize(make_router())
+# routers that were created before a fork; see connect_database
+inherited_databases = []
+
+
+def connect_database():
+    """
+    Give this process its own connection pools. Call once in each process
+    after forking, since a connection can't be shared between processes.
+    """
+
+    # the old pools' connections belong to the parent process, so keep them
+    # open; closing one would end the parent's session
+    inherited_databases.append(conn.obj)
+    conn.initialize(make_router())
+
+
+def check_replicas_periodically():
+    """ Start checking the replicas' health on the I/O loop, if there are any. """
+
+    if replica_configs:
+        PeriodicCallback(
+            lambda: run_query(conn.check_replicas),
+            HEALTH_CHECK_INTERVAL * 1000).start()
+
+
+def release_connection():
+    """
+    Return this thread's connections to their pools, unless they're in the
+    middle of a transaction.
+    """
+
+    for database in conn.databases():
+        if not database.is_closed() and not database.transaction_depth():
+            database.close()
+
+
+def read_config():
+    """
+    Return the connection parameters of a healthy replica, or of the
+    primary if there isn't one, for reads that need their own connection.
+    """
+
+    replica = conn.choose_replica()
+    return config if replica is None else replica.config
+
+
+export_slots = threading.BoundedSemaphore(EXPORT_CONNECTIONS)
+
+
+@contextmanager
+def export_connection():
+    """
+    Open a connection outside of the pool, for a read that needs one to
+    itself for longer than a query, like a server-side cursor that stays
+    open between chunks. Close it at the end of the block.
+
+    At most EXPORT_CONNECTIONS are open at once in each process; like the
+    pool, wait up to POOL_TIMEOUT seconds for one to close.
+    """
+
+    if not export_slots.acquire(timeout=POOL_TIMEOUT):
+        raise OperationalError("Timed out waiting for an export connection.")
+    try:
+        connection = psycopg2.connect(**read_config())
+        try:
+            yield connection
+        finally:
+            connection.close()
+    finally:
+        export_slots.release()
+
+
+def database_stats():
+    """ Return statistics about this process's connection pools. """
+
+    return conn.stats()
+
+
+# the threads that run blocking endpoints (see base_handler.py), which may
+# also query; they get their own share of the connections, so that they
+# can't crowd out the quick queries that query_executor runs
+BLOCKING_WORKERS = max(1, min(
+    int(os.environ.get("BLOCKING_WORKERS", MAX_CONNECTIONS // 4)),
+    POOL_CONNECTIONS - 2))
+
+# the threads that run queries for the I/O loop, leaving a connection for
+# anything that still queries on the I/O loop itself; together with the
+# blocking threads, they never need more than the pool's connections
+query_executor = ThreadPoolExecutor(
+    max_workers=max(1, POOL_CONNECTIONS - 1 - BLOCKING_WORKERS))
+
+
+def on_query_executor(fn, executor=query_executor):
+    """
+    Call fn on query_executor (or another executor), and return a Future
+    for its result.
+    """
+
+    def run():
+        try:
+            return fn()
+        finally:
+            release_connection()
+
+    future = Future()
+    chain_future(executor.submit(run), future)
+    return future
+
+
+def run_query(fn, *args, **kwargs):
+    """
+    Call a function that queries the database on query_executor, so that it
+    doesn't block the I/O loop, and return a Future for its result that a
+    handler can await. e.g.,
+
+    article = next(await run_query(get_article_object, pmid))
+
+    The function should execute its queries before it returns (so return
+    the result of .execute() or a list, rather than a query). The thread's
+    connection goes back to the pool afterwards.
+    """
+
+    return on_query_executor(lambda: fn(*args, **kwargs))
+
+
+def run_read_query(fn, *args, **kwargs):
+    """
+    Like run_query, but for a function that only reads, and can tolerate
+    replication lag (e.g., a search); if there are replicas, one of them
+    runs it, unless this process wrote in the last REPLICA_LAG_WINDOW
+    seconds. Handlers should call it through BaseHandler.read_query, which
+    also sends the reads of a client that wrote recently to the primary.
+    Reads that must always see the latest writes should use run_query,
+    which always goes to the primary.
+
+    If the replica fails, it's marked unhealthy and the primary runs the
+    function instead.
+    """
+
+    def read():
+        replica = conn.choose_replica()
+        if replica is not None:
+            try:
+                with conn.use(replica):
+                    return fn(*args, **kwargs)
+            except (OperationalError, InterfaceError):
+                conn.healthy.discard(replica)
+        return fn(*args, **kwargs)
+
+    return on_query_executor(read)
 
 
 class BaseModel(signals.Model):
@@ -49,8 +426,7 @@ class BaseModel(signals.Model):
         database_dict["PMID"] = PMID : (VarChar)
         database_dict["DOI"] = DOI : (VarChar)
         database_dict["NeuroSynthID"] = NeuroSynthID : (VarChar)
-        database_dict["Experiments"] = Experiments : (Text)
-        database_dict["Metadata"] = Metadata : (Text)
+        database_dict["Metadata"] = Metadata : (JSONB)
     """
 
     class Meta:
@@ -62,18 +438,118 @@ class Articles(BaseModel):
     abstract = CharField(null=True)
     authors = CharField(null=True)
     doi = CharField(null=True)
-    experiments = CharField(null=True)
-    metadata = CharField(null=True)
+    # experiment tables are stored in the Experiments and Peaks tables
+    metadata = BinaryJSONField(null=True)
     neurosynthid = CharField(null=True)
     pmid = CharField(null=True, unique=True)
     reference = CharField(null=True)
     title = CharField(null=True)
     uniqueid = peewee.PrimaryKeyField(null=True)
+    # full-text search vectors, maintained by a trigger (see migrations.py)
+    title_vector = TSVectorField(null=True)
+    abstract_vector = TSVectorField(null=True)
+    authors_vector = TSVectorField(null=True)
 
     class Meta:
         db_table = 'articles'
 
 
+class ArticleSummaries(BaseModel):
+    """
+    The columns of Articles that list views need (e.g., search results and
+    collections), kept current by a trigger on the articles table (see
+    migrations.py). Its rows are a fraction of the size of an article's.
+    """
+
+    uniqueid = IntegerField(primary_key=True)
+    pmid = CharField(null=True, index=True)
+    title = CharField(null=True)
+    authors = CharField(null=True)
+    reference = CharField(null=True)
+
+    class Meta:
+        db_table = 'article_summaries'
+
+
+class Counters(BaseModel):
+    """
+    Row counts that triggers keep current, so that they can be read
+    without counting the table (see migrations.py). e.g., the "articles"
+    counter is the number of articles.
+    """
+
+    name = CharField(primary_key=True)
+    value = BigIntegerField()
+
+    class Meta:
+        db_table = 'counters'
+
+
+class Experiments(BaseModel):
+    """
+    One experiment table from an article. The table's fields, other than its
+    id, locations, and votes, are stored in "document" (e.g., its title,
+    caption, and flag); its locations are rows in Peaks.
+    """
+
+    uniqueid = peewee.PrimaryKeyField()
+    pmid = CharField()
+    experiment = IntegerField()  # the "id" of the experiment
+    position = DoubleField()  # an article's tables are ordered by position
+    document = BinaryJSONField(null=True)
+
+    class Meta:
+        db_table = 'experiments'
+        indexes = (
+            (("pmid", "experiment"), True),
+        )
+
+
+class Peaks(BaseModel):
+    """
+    One location (i.e., row) of an experiment table. The location is stored
+    as it was entered, and its coordinates are parsed out so that spatial
+    searches can use an index; they're null if it couldn't be parsed.
+    """
+
+    uniqueid = peewee.PrimaryKeyField()
+    pmid = CharField(index=True)
+    experiment = IntegerField()  # the "id" of the experiment
+    location = CharField(null=True)  # e.g., "-26,54,14"
+    position = DoubleField(null=True)  # a table's rows are ordered by position
+    x = FloatField(null=True)
+    y = FloatField(null=True)
+    z = FloatField(null=True)
+    stat = FloatField(null=True)  # the fourth column, if any (e.g., z-score)
+
+    class Meta:
+        db_table = 'peaks'
+        indexes = (
+            (("x", "y", "z"), False),
+            (("pmid", "experiment", "position"), False),
+        )
+
+
+class Votes(BaseModel):
+    """
+    One user's vote about an article. "target" identifies what was voted on
+    (e.g., a MeSH heading, or a tag on an experiment table), and "value" is
+    the vote (e.g., "up", or a number of subjects). See article_helpers.
+    """
+
+    uniqueid = peewee.PrimaryKeyField()
+    pmid = CharField()
+    target = CharField()
+    username = CharField()
+    value = CharField(null=True)
+
+    class Meta:
+        db_table = 'votes'
+        indexes = (
+            (("pmid", "target", "username"), True),
+        )
+
+
 class Concepts(BaseModel):
     name = CharField(db_column='Name', null=True)
     definition = CharField(null=True)
@@ -108,6 +584,13 @@ class User(BaseModel):
 
     class Meta:
         db_table = 'users'
+        # the password column holds API keys, which are looked up on every
+        # authenticated request. The api-key-index migration creates this
+        # index; on a database where some users share a key, it falls back
+        # to a non-unique index of the same name, and prints their userids.
+        indexes = (
+            (("password",), True),
+        )
 
 
 class User_metadata(BaseModel):
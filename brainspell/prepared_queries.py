@@ -0,0 +1,71 @@
+"""
+Fast paths for the single-row lookups that run on almost every request:
+fetching an article by PMID, checking whether a PMID exists, and finding
+the user that an API key belongs to.
+
+Each statement is PREPAREd once per database connection, the first time
+that connection runs it, so Postgres parses and plans it once rather than
+on every call. Calls then EXECUTE the prepared statement through
+conn.execute_sql, which skips building and compiling a PeeWee query.
+"""
+
+from models import *
+
+# every column except the search vectors, which handlers never need
+ARTICLE_FIELDS = [field for field in Articles._meta.sorted_fields
+                  if not isinstance(field, TSVectorField)]
+
+# the parameter types and SQL of each prepared statement, by name
+STATEMENTS = {
+    "article_by_pmid": (
+        ("varchar",),
+        "SELECT {0} FROM articles WHERE pmid = $1".format(
+            ", ".join('"{0}"'.format(field.db_column)
+                      for field in ARTICLE_FIELDS))),
+    "article_exists": (
+        ("varchar",),
+        "SELECT 1 FROM articles WHERE pmid = $1 LIMIT 1"),
+    "user_by_api_key": (
+        ("varchar",),
+        "SELECT userid, username FROM users WHERE password = $1 LIMIT 1")
+}
+
+
+def execute_prepared(name, *params):
+    """
+    Run one of the STATEMENTS, preparing it first if this thread's
+    connection hasn't yet, and return the cursor.
+    """
+
+    connection = conn.get_conn()
+    if name not in connection.prepared:
+        types, sql = STATEMENTS[name]
+        conn.execute_sql("PREPARE {0} ({1}) AS {2}".format(
+            name, ", ".join(types), sql), require_commit=False)
+        connection.prepared.add(name)
+    return conn.execute_sql("EXECUTE {0} ({1})".format(
+        name, ", ".join(["%s"] * len(params))), params, require_commit=False)
+
+
+def fetch_article(pmid):
+    """ Return the Articles object for a PMID, or None if there isn't one. """
+
+    row = execute_prepared("article_by_pmid", str(pmid)).fetchone()
+    if row is None:
+        return None
+    return Articles(**dict(zip((field.name for field in ARTICLE_FIELDS), row)))
+
+
+def article_exists(pmid):
+    """ Return whether a PMID is in our database. """
+
+    return execute_prepared("article_exists", str(pmid)).fetchone() is not None
+
+
+def fetch_user(api_key):
+    """
+    Return a (userid, username) tuple for the user that an API key belongs
+    to, or None if the key isn't valid.
+    """
+
+    return execute_prepared("user_by_api_key", api_key).fetchone()
@@ -1,21 +1,185 @@
 # functions related to search
 
+import base64
+import json
+import os
+import random
 import re
+import time
+from bisect import bisect_right
+from collections import namedtuple
 from functools import reduce
 
+import search_index
+from caching import LRUCache
 from models import *
+from prepared_queries import ARTICLE_FIELDS, fetch_article
+
+SEARCH_PAGE_SIZE = 10
+COORDINATES_PAGE_SIZE = 200
+# the number of peaks that a coordinates export reads from Postgres at a time
+EXPORT_CHUNK_SIZE = 2000
+# searches with at most this many hits are counted exactly
+EXACT_COUNT_LIMIT = 1000
+
+# "fulltext" searches the maintained tsvector columns (see migrations.py);
+# "match" falls back to building a tsvector for every row at query time;
+# "memory" searches an in-process index (see search_index.py), and uses
+# "fulltext" for the queries that the index can't answer
+SEARCH_ENGINE = os.environ.get("SEARCH_ENGINE", "fulltext")
+
+# random_search draws from a pool of this many uniqueids, which is
+# resampled every RANDOM_POOL_TTL seconds
+RANDOM_POOL_SIZE = 1000
+RANDOM_POOL_TTL = int(os.environ.get("RANDOM_POOL_TTL", 600))
+random_pool = {
+    "ids": [],
+    "expires": 0
+}
+
+
+class SearchCache(LRUCache):
+    """
+    The cache of search results, which writes to articles invalidate.
+    Invalidating it also keeps reads on the primary database for a while
+    (see DatabaseRouter.mark_written), so that the next searches, and the
+    results that are cached from them, include the write even if the
+    replicas are behind.
+    """
+
+    def invalidate(self):
+        super(SearchCache, self).invalidate()
+        conn.mark_written()
+
+
+# cached search results, invalidated whenever an article is added or its
+# searchable fields change (see invalidate_searches); the results of
+# searches that read the experiment tables are cached apart, so that the
+# more frequent table edits only invalidate those (see cache_for)
+search_cache = SearchCache(
+    max_size=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("SEARCH_CACHE_TTL", 300)))
+experiments_cache = SearchCache(
+    max_size=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("SEARCH_CACHE_TTL", 300)))
+
+
+def cache_for(query, param=None, experiments=False):
+    """
+    Return the cache for the results of a search: experiments_cache if
+    they depend on the experiment tables (searches of the tables, [ALL]
+    searches, and coordinates), or search_cache.
+    """
+
+    if experiments or param == "x" or "[ALL]" in query:
+        return experiments_cache
+    return search_cache
+
+
+def invalidate_searches():
+    """
+    Invalidate every cached search, after an article is added or its
+    title, abstract, authors, or MeSH headings change.
+    """
+
+    search_cache.invalidate()
+    experiments_cache.invalidate()
+
+
+def invalidate_experiment_searches():
+    """
+    Invalidate the cached searches that read the experiment tables, after
+    an edit to an article's tables.
+    """
+
+    experiments_cache.invalidate()
+
+
+# the maintained tsvector column for each searchable text column, and the
+# text search configuration that it was built with
+VECTOR_COLUMNS = {
+    "title": (Articles.title_vector, "english"),
+    "abstract": (Articles.abstract_vector, "english"),
+    "authors": (Articles.authors_vector, "simple")
+}
+
+ArticleLocations = namedtuple(
+    "ArticleLocations", ["uniqueid", "pmid", "locations"])
+
+
+def refresh_random_pool():
+    """
+    Resample the pool of uniqueids that random_search draws from.
+
+    TABLESAMPLE SYSTEM reads a fixed number of random pages, so the cost of
+    a refresh depends on RANDOM_POOL_SIZE rather than on the table size.
+    """
+
+    estimate = conn.execute_sql(
+        "SELECT reltuples FROM pg_class WHERE relname = 'article_summaries'").fetchone()
+    # oversample, since whole pages are sampled at a time
+    percent = 100.0
+    if estimate and estimate[0] > 0:
+        percent = min(100.0, 200.0 * RANDOM_POOL_SIZE / estimate[0])
+    ids = [row[0] for row in conn.execute_sql(
+        "SELECT uniqueid FROM article_summaries TABLESAMPLE SYSTEM (%s)",
+        (percent,)).fetchall()]
+    if len(ids) > RANDOM_POOL_SIZE:
+        ids = random.sample(ids, RANDOM_POOL_SIZE)
+    random_pool["ids"] = ids
+    random_pool["expires"] = time.time() + RANDOM_POOL_TTL
 
 
 def random_search():
     """ Return five random articles from our database. """
-    search = Articles.select(
-        Articles.pmid,
-        Articles.title,
-        Articles.authors).order_by(
-        fn.Random()).limit(5)
+
+    if random_pool["expires"] < time.time() or len(random_pool["ids"]) < 5:
+        refresh_random_pool()
+    ids = random_pool["ids"]
+    if not ids:
+        return []
+    search = ArticleSummaries.select(
+        ArticleSummaries.pmid,
+        ArticleSummaries.title,
+        ArticleSummaries.authors).where(
+        ArticleSummaries.uniqueid << random.sample(ids, min(5, len(ids))))
     return search.execute()
 
 
+def compile_tsquery(query):
+    """
+    Compile free text into a tsquery string that requires every word.
+    Return the empty string if the text contains no words.
+    """
+
+    return " & ".join(re.findall(r"\w+", query))
+
+
+def as_text(column):
+    """
+    Cast a JSONB column to text, so that the whole document can be matched
+    like the strings that it replaced. Other columns are returned as-is.
+    """
+
+    if isinstance(column, BinaryJSONField):
+        return fn.CAST(Clause(column, SQL("AS text")))
+    return column
+
+
+def text_match(column, query):
+    """
+    Return a predicate that matches a column against a search query, using
+    the column's maintained tsvector if it has one.
+    """
+
+    if SEARCH_ENGINE != "match" and column.name in VECTOR_COLUMNS:
+        vector, config = VECTOR_COLUMNS[column.name]
+        return Expression(
+            vector, OP.TS_MATCH, fn.to_tsquery(
+                config, compile_tsquery(query)))
+    return Match(as_text(column), query.strip().replace(" ", "%"))
+
+
 # helper function for search queries, generates match objects of target
 # columns for search if user specified
 def parse_helper(query):
@@ -39,8 +203,7 @@ def parse_helper(query):
         columns.append(Articles.authors)
     if all.search(query):
         columns.extend([Articles.abstract,
-                        Articles.authors, Articles.doi,
-                        Articles.experiments, Articles.metadata,
+                        Articles.authors, Articles.doi, Articles.metadata,
                         Articles.neurosynthid, Articles.pmid,
                         Articles.reference, Articles.title])
     if mesh.search(query):
@@ -49,92 +212,414 @@ def parse_helper(query):
         columns.append(Articles.pmid)
     if tiab.search(query):
         columns.extend([Articles.title, Articles.abstract])
-    formatted_query = re.sub(r'\[.*\]', '', query).strip().replace(" ", "%")
+    formatted_query = re.sub(r'\[.*\]', '', query).strip()
     if not columns:
         return (None, None, formatted_query)
-    matches = [Match(col, formatted_query) for col in columns]
+    matches = [text_match(col, formatted_query) for col in columns]
+    if all.search(query):
+        matches.append(experiments_match(formatted_query))
     term = reduce(lambda x, y: x | y, matches)
     return (columns, term, formatted_query)
 
 
+def experiments_match(query):
+    """
+    Return a predicate for the articles with an experiment table whose
+    locations or fields (e.g., its title or caption) match a query.
+    """
+
+    query = query.strip().replace(" ", "%")
+    return (Articles.pmid << Peaks.select(Peaks.pmid).where(
+        Match(Peaks.location, query))) | (
+        Articles.pmid << Experiments.select(Experiments.pmid).where(
+            Match(as_text(Experiments.document), query)))
+
+
+def search_memory_index(query, param=None):
+    """
+    Return the sorted uniqueids that match a search from the in-memory
+    index, or None if it's disabled, still building, or can't answer the
+    query.
+    """
+
+    if SEARCH_ENGINE != "memory" or not search_index.index.ready:
+        return None
+    return search_index.index.search(query, param)
+
+
+def search_predicate(query, param=None):
+    """
+    Return the WHERE clause for a search query, or None if the query
+    can't match anything. "param" is the dropdown value from the search bar.
+    """
+
+    columns, term, query = parse_helper(query)
+    if SEARCH_ENGINE != "match" and not compile_tsquery(query):
+        # an empty tsquery matches nothing, and Postgres warns about it
+        return None
+    if columns:
+        return term
+    if param == "x":
+        return experiments_match(query)
+    if param == "p":
+        return Match(Articles.pmid, query.replace(" ", "%"))
+    if param == "r":
+        return Match(Articles.reference, query.replace(" ", "%"))
+    return text_match(
+        Articles.title,
+        query) | text_match(
+        Articles.authors,
+        query) | text_match(
+        Articles.abstract,
+        query)
+
+
+def encode_cursor(uniqueid):
+    """ Return an opaque pagination cursor that continues after an article. """
+
+    return base64.urlsafe_b64encode(
+        json.dumps({"after": uniqueid}).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    """
+    Reverse encode_cursor, returning the uniqueid to continue after.
+    The empty string (no cursor) decodes to None.
+    """
+
+    if not cursor:
+        return None
+    after = json.loads(base64.urlsafe_b64decode(
+        cursor.encode("utf-8")).decode("utf-8"))["after"]
+    if not isinstance(after, int):
+        raise ValueError("Malformed cursor.")
+    return after
+
+
 # param specifies dropdown value from search bar; experiments specifies
 # whether to only return the experiments
-def formatted_search(query, start, param=None, experiments=False):
+def formatted_search(query, start, param=None, experiments=False, after=None):
     """
-    Return either the results of a search, or the experiments that
-    correspond to the articles. (based on the "experiments" flag)
+    Return either the results of a search, or the locations from the
+    experiment tables of the articles, as ArticleLocations. (based on the
+    "experiments" flag)
+
+    Results are ordered by uniqueid. If "after" (a uniqueid decoded from a
+    cursor) is given, continue after that article and ignore "start".
+
+    Results are served from the cache (see cache_for) when possible.
     """
 
-    columns, term, formatted_query = parse_helper(query)
-    query = formatted_query
-    if columns:
-        search = Articles.select(
-            Articles.pmid,
-            Articles.title,
-            Articles.authors).where(term).limit(10).offset(start)
-        return search.execute()
+    key = ("search", query, start, param, experiments, after)
+    cache = cache_for(query, param, experiments)
+    generation = cache.generation
+    results = cache.get(key)
+    if results is None:
+        results = list(search_articles(
+            query, start, param, experiments, after))
+        cache.put(key, results, generation)
+    return results
+
+
+def search_articles(query, start, param=None, experiments=False, after=None):
+    """ Run a search for formatted_search, bypassing the cache. """
+
+    if not experiments:
+        indexed = search_memory_index(query, param)
+        if indexed is not None:
+            if after is not None:
+                start = bisect_right(indexed, after)
+            return search_index.index.get(
+                indexed[start:start + SEARCH_PAGE_SIZE])
+
+    match = search_predicate(query, param)
+    if match is None:
+        return []
+    fields = (Articles.pmid, Articles.title, Articles.authors)
+    numberResults = SEARCH_PAGE_SIZE
+    if experiments:
+        fields = (Articles.pmid,)
+        numberResults = COORDINATES_PAGE_SIZE
+    search = Articles.select(Articles.uniqueid, *fields).where(match)
+    if after is not None:
+        # seek past the previous page using the primary key, rather than
+        # counting through it with OFFSET
+        search = search.where(Articles.uniqueid > after)
     else:
-        match = Match(
-            Articles.title,
-            query) | Match(
-            Articles.authors,
-            query) | Match(
-            Articles.abstract,
-            query)
-        if param == "x":
-            match = Match(Articles.experiments, query)
-        if param == "p":
-            match = Match(Articles.pmid, query)
-        if param == "r":
-            match = Match(Articles.reference, query)
-        # return (search.count(), search.limit(10).offset(start).execute()) #
-        # give the total number of results, and output ten results, offset by
-        # "start"
-        fields = (Articles.pmid, Articles.title, Articles.authors)
-        numberResults = 10
-        if experiments:
-            fields = (Articles.experiments,)
-            numberResults = 200
-        # search.count() makes the above line slow; TODO: find a better way of
-        # doing this
-        return Articles.select(
-            *fields).where(match).limit(numberResults).offset(start).execute()
+        search = search.offset(start)
+    results = search.order_by(
+        Articles.uniqueid).limit(numberResults).execute()
+    if experiments:
+        return with_locations(results)
+    return results
+
+
+def with_locations(articles):
+    """
+    Return an ArticleLocations for each article, with the locations of all
+    of its experiment tables, in order.
+    """
+
+    articles = list(articles)
+    locations = {article.pmid: [] for article in articles}
+    if articles:
+        peaks = Peaks.select(Peaks.pmid, Peaks.location).join(
+            Experiments, on=(
+                (Experiments.pmid == Peaks.pmid) &
+                (Experiments.experiment == Peaks.experiment))).where(
+            Peaks.pmid << list(locations)).order_by(
+            Peaks.pmid, Experiments.position, Peaks.experiment, Peaks.position)
+        for peak in peaks.naive().execute():
+            locations[peak.pmid].append(peak.location)
+    return [ArticleLocations(a.uniqueid, a.pmid, locations[a.pmid])
+            for a in articles]
+
+
+def ranked_search(query, start, param=None):
+    """
+    Return a page of the best matches for a search, best first, each with a
+    "score". Results are served from the cache when possible.
+    """
+
+    key = ("ranked", query, start, param)
+    cache = cache_for(query, param)
+    generation = cache.generation
+    results = cache.get(key)
+    if results is None:
+        results = list(rank_articles(query, start, param))
+        cache.put(key, results, generation)
+    return results
+
+
+def rank_memory_index(query, param=None, k=SEARCH_PAGE_SIZE):
+    """
+    Return the top k (uniqueid, score) pairs for a search from the in-memory
+    index, or None if it can't answer the query.
+    """
+
+    if SEARCH_ENGINE != "memory" or not search_index.index.ready:
+        return None
+    return search_index.index.rank(query, param, k)
+
+
+def rank_expression(query):
+    """
+    Return an expression that scores an article against a search query:
+    the sum of ts_rank_cd over each maintained tsvector, weighted by
+    search_index.FIELD_WEIGHTS.
+    """
+
+    tsquery = compile_tsquery(query)
+    scores = []
+    for name, (vector, config) in sorted(VECTOR_COLUMNS.items()):
+        # normalization 1 divides by 1 + log(length), so long abstracts
+        # don't win on volume alone
+        scores.append(fn.COALESCE(fn.ts_rank_cd(
+            vector, fn.to_tsquery(config, tsquery), 1), 0) *
+            search_index.FIELD_WEIGHTS[name])
+    return reduce(lambda x, y: x + y, scores)
+
+
+def rank_articles(query, start, param=None):
+    """ Run a search for ranked_search, bypassing the cache. """
+
+    ranked = rank_memory_index(query, param, start + SEARCH_PAGE_SIZE)
+    if ranked is not None:
+        return search_index.index.get_scored(ranked[start:])
+
+    match = search_predicate(query, param)
+    if match is None:
+        return []
+    if SEARCH_ENGINE == "match":
+        # there are no maintained vectors to rank with
+        score = SQL("0")
+    else:
+        score = rank_expression(parse_helper(query)[2])
+    # with a LIMIT, Postgres keeps only the top rows in a bounded heap
+    # rather than sorting every match
+    search = Articles.select(
+        Articles.uniqueid,
+        Articles.pmid,
+        Articles.title,
+        Articles.authors,
+        score.alias("score")).where(match)
+    return search.order_by(
+        SQL("score").desc(),
+        Articles.uniqueid).offset(start).limit(SEARCH_PAGE_SIZE).execute()
+
+
+def count_search_results(query, param=None):
+    """
+    Return a tuple (count, approximate) for the number of articles that
+    match a search. Count exactly if there are at most EXACT_COUNT_LIMIT
+    hits; otherwise, use the query planner's estimate, which costs no scan.
+    """
+
+    key = ("count", query, param)
+    cache = cache_for(query, param)
+    generation = cache.generation
+    count = cache.get(key)
+    if count is None:
+        count = count_articles(query, param)
+        cache.put(key, count, generation)
+    return count
+
+
+def count_articles(query, param=None):
+    """ Count the hits for count_search_results, bypassing the cache. """
+
+    indexed = search_memory_index(query, param)
+    if indexed is not None:
+        return (len(indexed), False)
+
+    match = search_predicate(query, param)
+    if match is None:
+        return (0, False)
+    search = Articles.select(Articles.uniqueid).where(match)
+
+    # stop counting once we know that the exact count isn't cheap
+    exact = search.limit(EXACT_COUNT_LIMIT + 1).count()
+    if exact <= EXACT_COUNT_LIMIT:
+        return (exact, False)
+
+    sql, params = search.sql()
+    plan = conn.execute_sql(
+        "EXPLAIN (FORMAT JSON) " + sql, params).fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    # the planner may underestimate, but we know there are more hits than this
+    return (max(int(plan[0]["Plan"]["Plan Rows"]), exact), True)
+
+
+def next_cursor(results, page_size):
+    """
+    Return the cursor for the page after "results", or None if
+    "results" is the last page.
+    """
+
+    results = list(results)
+    if len(results) < page_size:
+        return None
+    return encode_cursor(results[-1].uniqueid)
 
 
 def get_article_object(query):
-    """ Get a single article PeeWee object. """
+    """
+    Get a single article PeeWee object, as an iterator that's empty if
+    the PMID isn't in our database.
+    """
 
-    search = Articles.select().where(Articles.pmid == query)
-    return search.execute()
+    article = fetch_article(query)
+    return iter([article] if article is not None else [])
+
+
+def get_article_summaries(pmids):
+    """
+    Return a dictionary from PMID to the ArticleSummaries row for each of
+    the PMIDs that's in our database, in one query.
+    """
+
+    pmids = [str(p) for p in pmids]
+    if not pmids:
+        return {}
+    return {summary.pmid: summary for summary in ArticleSummaries.select(
+    ).where(ArticleSummaries.pmid << pmids).execute()}
+
+
+def peaks_near(coordinate, radius):
+    """ Return the Peaks within "radius" mm of an (x, y, z) coordinate. """
+
+    x, y, z = coordinate
+    # the bounding box uses the index; the distance check is exact
+    return Peaks.select().where(
+        Peaks.x.between(x - radius, x + radius),
+        Peaks.y.between(y - radius, y + radius),
+        Peaks.z.between(z - radius, z + radius),
+        (Peaks.x - x) * (Peaks.x - x) +
+        (Peaks.y - y) * (Peaks.y - y) +
+        (Peaks.z - z) * (Peaks.z - z) <= radius * radius).execute()
 
 
-def generate_circle(coordinate):  # Coordinate of form "-26,54,14"
-    """ Specify a range around a given coordinate to search the database. """
+def coactivated_peaks(coordinate, radius=1):  # Coordinate of form "-26,54,14"
+    """
+    Return the Peaks of every experiment that reports a peak within
+    "radius" mm of a given coordinate, grouped by experiment.
+    """
 
-    ordered = [int(x) for x in coordinate.split(",")][0:3]  # Ignore z-score
-    search_terms = []
-    for i in range(len(ordered)):
-        for j in range(-1, 2, 1):
-            val = list(ordered)
-            val[i] = val[i] + j
-            search_terms.append(",".join([str(x) for x in val]))
-    return search_terms
+    center = [float(x) for x in coordinate.split(",")][0:3]  # Ignore z-score
+    experiments = {(p.pmid, p.experiment)
+                   for p in peaks_near(center, radius)}
+    if not experiments:
+        return []
+    pmids = list({pmid for pmid, experiment in experiments})
+    peaks = Peaks.select().where(Peaks.pmid << pmids).order_by(
+        Peaks.pmid, Peaks.experiment, Peaks.position).execute()
+    return [peak for peak in peaks
+            if (peak.pmid, peak.experiment) in experiments]
 
 
-def coactivation(coordinate):  # yields around 11,000 coordinates
+def coactivation(coordinate, radius=1):  # Coordinate of form "-26,54,14"
     """
-    Find coordinates associated with a range around a given coordinate.
+    Find the coordinates of every experiment that reports a peak within
+    "radius" mm of a given coordinate. Return a list with the locations of
+    each of those experiments.
     """
 
-    coordinate_sets = []
-    search_circle = generate_circle(coordinate)
-    for item in search_circle:
-        val = Articles.select(Articles.experiments).where(
-            Match(Articles.experiments, item)
-        ).execute()
-        for item in val:
-            data_set = eval(item.experiments)
-            for location_sets in data_set:
-                if location_sets.get("locations"):
-                    coordinate_sets.append(location_sets["locations"])
-    return coordinate_sets
+    coordinate_sets = {}
+    for peak in coactivated_peaks(coordinate, radius):
+        coordinate_sets.setdefault(
+            (peak.pmid, peak.experiment), []).append(peak.location)
+    return list(coordinate_sets.values())
+
+
+def stream_coordinates(query, param=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield lists of the experiments that match a search, as dictionaries
+    with a "pmid", an "experiment" id, and a list of "coordinates".
+
+    Peaks are read through a server-side cursor, "chunk_size" at a time, so
+    memory use doesn't grow with the number of matches. The cursor needs a
+    transaction that stays open between chunks, so it gets a dedicated
+    connection from export_connection rather than sharing this thread's.
+    Close the generator to close the connection early.
+    """
+
+    match = search_predicate(query, param)
+    if match is None:
+        return
+    articles = Articles.select(Articles.pmid).where(match)
+    peaks = Peaks.select(
+        Peaks.pmid,
+        Peaks.experiment,
+        Peaks.location).join(
+        Experiments, on=(
+            (Experiments.pmid == Peaks.pmid) &
+            (Experiments.experiment == Peaks.experiment))).where(
+        Peaks.pmid << articles).order_by(
+        Peaks.pmid,
+        Experiments.position,
+        Peaks.experiment,
+        Peaks.position)
+    sql, params = peaks.sql()
+    with export_connection() as connection:
+        cursor = connection.cursor(name="coordinates_export")
+        cursor.execute(sql, params)
+        experiments = []
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for pmid, experiment, location in rows:
+                if not experiments or experiments[-1]["pmid"] != pmid or \
+                        experiments[-1]["experiment"] != experiment:
+                    experiments.append({
+                        "pmid": pmid,
+                        "experiment": experiment,
+                        "coordinates": []
+                    })
+                experiments[-1]["coordinates"].append(location)
+            # the last experiment may continue in the next chunk
+            yield experiments[:-1]
+            experiments = experiments[-1:]
+        if experiments:
+            yield experiments
@@ -0,0 +1,395 @@
+"""
+An optional in-memory inverted index for searching articles.
+
+When the SEARCH_ENGINE environment variable is "memory", each Brainspell
+process builds an inverted index over the title, abstract, authors, and MeSH
+headings of every article at startup, and searches it instead of Postgres.
+
+Posting lists are arrays of uniqueids, kept sorted, so results come out in
+the same order as a database search. Writes keep the index current through
+PeeWee's post_save and post_delete signals. Because production forks a
+process per core, every write is also broadcast with Postgres NOTIFY, so
+that the other processes can reindex the article.
+
+Like the database's full-text search, English stop words are ignored in
+titles and abstracts (but not authors, which Postgres searches with the
+"simple" configuration). Unlike it, terms are not stemmed.
+"""
+
+import ast
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+
+import psycopg2
+import psycopg2.extensions
+import tornado.ioloop
+
+from models import *
+
+INDEXED_FIELDS = ("title", "abstract", "authors", "mesh")
+DEFAULT_FIELDS = ("title", "authors", "abstract")
+# the PubMed tags that the index can answer, and the fields they search
+TAG_FIELDS = {
+    "[au]": ("authors",),
+    "[MH]": ("mesh",),
+    "[TIAB]": ("title", "abstract")
+}
+NOTIFY_CHANNEL = "brainspell_articles"
+# the relative importance of a match in each field, for ranked searches
+FIELD_WEIGHTS = {
+    "title": 1.0,
+    "abstract": 0.2,
+    "authors": 0.4,
+    "mesh": 0.4
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+# term frequencies are stored as unsigned shorts
+MAX_FREQUENCY = 65535
+# the stop words of Postgres's "english" text search configuration, which
+# to_tsquery drops from searches of these fields
+STOP_WORD_FIELDS = ("title", "abstract")
+STOP_WORDS = frozenset("""
+    i me my myself we our ours ourselves you your yours yourself yourselves
+    he him his himself she her hers herself it its itself they them their
+    theirs themselves what which who whom this that these those am is are
+    was were be been being have has had having do does did doing a an the
+    and but if or because as until while of at by for with about against
+    between into through during before after above below to from up down in
+    out on off over under again further then once here there when where why
+    how all any both each few more most other some such no nor not only own
+    same so than too very s t can will just don should now""".split())
+# the columns that the index is built from
+INDEXED_COLUMNS = (
+    Articles.uniqueid,
+    Articles.pmid,
+    Articles.title,
+    Articles.authors,
+    Articles.abstract,
+    Articles.metadata)
+
+IndexedArticle = namedtuple(
+    "IndexedArticle", ["uniqueid", "pmid", "title", "authors"])
+ScoredArticle = namedtuple(
+    "ScoredArticle", IndexedArticle._fields + ("score",))
+
+
+def tokenize(text):
+    """ Split text into lowercase terms. """
+
+    return [sys.intern(t) for t in re.findall(r"\w+", (text or "").lower())]
+
+
+def field_terms(field, terms):
+    """ Return the terms that a search of a field uses. """
+
+    if field in STOP_WORD_FIELDS:
+        return [t for t in terms if t not in STOP_WORDS]
+    return terms
+
+
+def mesh_headings(metadata):
+    """ Return the names of the MeSH headings in an article's metadata. """
+
+    if not metadata:
+        return []
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except BaseException:
+            try:
+                # older rows are Python literals rather than JSON
+                metadata = ast.literal_eval(metadata)
+            except BaseException:
+                return []
+    try:
+        return [h["name"] for h in metadata.get("meshHeadings", [])
+                if isinstance(h, dict) and "name" in h]
+    except BaseException:
+        return []
+
+
+def insert_sorted(postings, frequencies, uniqueid, frequency):
+    """
+    Insert a uniqueid into a sorted posting list, along with its term
+    frequency in the parallel frequencies array.
+    """
+
+    frequency = min(frequency, MAX_FREQUENCY)
+    if not postings or postings[-1] < uniqueid:
+        postings.append(uniqueid)
+        frequencies.append(frequency)
+    else:
+        i = bisect_left(postings, uniqueid)
+        if postings[i] == uniqueid:
+            frequencies[i] = frequency
+        else:
+            postings.insert(i, uniqueid)
+            frequencies.insert(i, frequency)
+
+
+class InvertedIndex(object):
+    """
+    Map each term in each indexed field to a sorted array of the uniqueids
+    of the articles that contain it, and a parallel array of how many times
+    the term appears in each of them (for BM25).
+    """
+
+    def __init__(self):
+        self.postings = {field: {} for field in INDEXED_FIELDS}
+        self.frequencies = {field: {} for field in INDEXED_FIELDS}
+        self.articles = {}
+        # the terms that each article was indexed under, so that it can be
+        # removed without knowing its old contents
+        self.article_terms = {}
+        # the number of terms in each field of each article, and in total
+        self.lengths = {}
+        self.total_lengths = {field: 0 for field in INDEXED_FIELDS}
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def add(self, article):
+        """ Index an article, replacing any previous version of it. """
+
+        texts = {
+            "title": article.title,
+            "abstract": article.abstract,
+            "authors": article.authors,
+            "mesh": " ".join(mesh_headings(article.metadata))
+        }
+        tokens = [field_terms(field, tokenize(texts[field]))
+                  for field in INDEXED_FIELDS]
+        counts = [Counter(field_tokens) for field_tokens in tokens]
+        with self.lock:
+            self._remove(article.uniqueid)
+            for field, field_counts in zip(INDEXED_FIELDS, counts):
+                postings = self.postings[field]
+                frequencies = self.frequencies[field]
+                for term, count in field_counts.items():
+                    if term not in postings:
+                        postings[term] = array("i")
+                        frequencies[term] = array("H")
+                    insert_sorted(
+                        postings[term],
+                        frequencies[term],
+                        article.uniqueid,
+                        count)
+            for field, field_tokens in zip(INDEXED_FIELDS, tokens):
+                self.total_lengths[field] += len(field_tokens)
+            self.articles[article.uniqueid] = IndexedArticle(
+                article.uniqueid, article.pmid, article.title, article.authors)
+            self.article_terms[article.uniqueid] = tuple(
+                tuple(field_counts) for field_counts in counts)
+            self.lengths[article.uniqueid] = tuple(
+                len(field_tokens) for field_tokens in tokens)
+
+    def remove(self, uniqueid):
+        """ Remove an article from the index, if it's there. """
+
+        with self.lock:
+            self._remove(uniqueid)
+
+    def _remove(self, uniqueid):
+        terms = self.article_terms.pop(uniqueid, None)
+        if terms is None:
+            return
+        del self.articles[uniqueid]
+        lengths = self.lengths.pop(uniqueid)
+        for field, field_terms, length in zip(INDEXED_FIELDS, terms, lengths):
+            self.total_lengths[field] -= length
+            postings = self.postings[field]
+            frequencies = self.frequencies[field]
+            for term in field_terms:
+                lst = postings[term]
+                i = bisect_left(lst, uniqueid)
+                if i < len(lst) and lst[i] == uniqueid:
+                    del lst[i]
+                    del frequencies[term][i]
+                if not lst:
+                    del postings[term]
+                    del frequencies[term]
+
+    def parse(self, query, param=None):
+        """
+        Return a tuple (fields, terms) for a search, or None if the index
+        can't answer it (e.g., a PMID or experiments search).
+        """
+
+        fields = []
+        for tag in re.findall(r"\[[^\]]*\]", query):
+            if tag not in TAG_FIELDS:
+                return None
+            fields.extend(TAG_FIELDS[tag])
+        if not fields:
+            if param not in (None, "t"):
+                return None
+            fields = DEFAULT_FIELDS
+        return (fields, set(tokenize(re.sub(r"\[.*\]", "", query))))
+
+    def _match(self, fields, terms):
+        matches = set()
+        if not terms:
+            return matches
+        for field in fields:
+            postings = self.postings[field]
+            lists = [postings.get(term) for term in field_terms(field, terms)]
+            if not lists or not all(lists):
+                continue
+            lists.sort(key=len)
+            matches.update(set(lists[0]).intersection(*lists[1:]))
+        return matches
+
+    def search(self, query, param=None):
+        """
+        Return the sorted uniqueids of the articles that match a search, with
+        the same semantics as search_helpers.formatted_search: every term
+        must appear in at least one of the searched fields.
+
+        Return None if the index can't answer the query, in which case the
+        database should be used.
+        """
+
+        parsed = self.parse(query, param)
+        if parsed is None:
+            return None
+        with self.lock:
+            return sorted(self._match(*parsed))
+
+    def rank(self, query, param=None, k=10):
+        """
+        Return up to k (uniqueid, score) pairs for the articles that match a
+        search, best first. Articles are scored with BM25 in each searched
+        field, weighted by FIELD_WEIGHTS. A heap selects the top k, so the
+        matches are never fully sorted.
+
+        Return None if the index can't answer the query.
+        """
+
+        parsed = self.parse(query, param)
+        if parsed is None:
+            return None
+        fields, terms = parsed
+        with self.lock:
+            scores = dict.fromkeys(self._match(fields, terms), 0.0)
+            n = len(self.articles)
+            for field in fields:
+                i = INDEXED_FIELDS.index(field)
+                average_length = (self.total_lengths[field] / n) or 1.0
+                for term in field_terms(field, terms):
+                    postings = self.postings[field].get(term)
+                    if not postings:
+                        continue
+                    df = len(postings)
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    weight = FIELD_WEIGHTS[field] * idf
+                    for uniqueid, tf in zip(
+                            postings, self.frequencies[field][term]):
+                        if uniqueid in scores:
+                            relative_length = self.lengths[uniqueid][i] / \
+                                average_length
+                            norm = BM25_K1 * \
+                                (1 - BM25_B + BM25_B * relative_length)
+                            scores[uniqueid] += weight * tf * \
+                                (BM25_K1 + 1) / (tf + norm)
+        # break ties in favor of older articles, like an unranked search
+        return heapq.nlargest(
+            k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+    def get(self, uniqueids):
+        """ Return the IndexedArticle for each uniqueid. """
+
+        with self.lock:
+            return [self.articles[u] for u in uniqueids if u in self.articles]
+
+    def get_scored(self, ranked):
+        """ Return a ScoredArticle for each (uniqueid, score) pair. """
+
+        with self.lock:
+            return [ScoredArticle(*self.articles[u], score=score)
+                    for u, score in ranked if u in self.articles]
+
+    def build(self):
+        """ Index every article in the database. """
+
+        articles = Articles.select(
+            *INDEXED_COLUMNS).order_by(Articles.uniqueid)
+        for article in articles.naive().iterator():
+            self.add(article)
+        self.ready = True
+
+    def reindex(self, uniqueid):
+        """ Reload an article from the database after it changed. """
+
+        articles = list(Articles.select(*INDEXED_COLUMNS).where(
+            Articles.uniqueid == uniqueid).execute())
+        if articles:
+            self.add(articles[0])
+        else:
+            self.remove(uniqueid)
+
+
+index = InvertedIndex()
+
+
+def notify_other_processes(uniqueid):
+    """ Tell the other Brainspell processes to reindex an article. """
+
+    conn.execute_sql("SELECT pg_notify(%s, %s)", (
+        NOTIFY_CHANNEL, "{0}:{1}".format(os.getpid(), uniqueid)))
+
+
+@signals.post_save(sender=Articles)
+def index_saved_article(model_class, instance, created):
+    """ Reindex an article when it's saved. """
+
+    if index.ready and instance.uniqueid is not None:
+        index.add(instance)
+        notify_other_processes(instance.uniqueid)
+
+
+@signals.post_delete(sender=Articles)
+def unindex_deleted_article(model_class, instance):
+    """ Remove an article from the index when it's deleted. """
+
+    if index.ready and instance.uniqueid is not None:
+        index.remove(instance.uniqueid)
+        notify_other_processes(instance.uniqueid)
+
+
+def listen_for_changes():
+    """
+    Reindex articles that other processes announce with NOTIFY.
+    Uses a dedicated connection, which is polled by the I/O loop.
+    """
+
+    listener = psycopg2.connect(**config)
+    listener.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listener.cursor().execute("LISTEN " + NOTIFY_CHANNEL)
+
+    def on_notify(fd, events):
+        listener.poll()
+        while listener.notifies:
+            notification = listener.notifies.pop(0)
+            sender, uniqueid = notification.payload.split(":")
+            # this process already updated its own index
+            if int(sender) != os.getpid():
+                index.reindex(int(uniqueid))
+
+    tornado.ioloop.IOLoop.current().add_handler(
+        listener.fileno(), on_notify, tornado.ioloop.IOLoop.READ)
+
+
+def start():
+    """ Build the index and keep it current. Call once per process. """
+
+    listen_for_changes()
+    index.build()
@@ -1,7 +1,9 @@
 """ To run this file, run `py.test -v test_tornado.py`. """
 
 import hashlib
+import json
 import os
+import urllib.parse
 
 import autopep8
 import pytest
@@ -10,7 +12,14 @@ import tornado.web
 import brainspell
 import github_collections
 import json_api
+import search_index
 import user_interface
+from article_helpers import merge_votes, table_rows
+from base_handler import compile_validator
+from caching import LRUCache
+from density_helpers import MNI_SHAPE, density_map
+from metrics import RequestMetrics
+from migrations import legacy_votes, parse_document
 from search_helpers import *
 
 #import selenium
@@ -140,6 +149,168 @@ def test_search():
     assert len(formatted_search("brain", 0)) > 0, SEARCH_BROKEN
 
 
+def test_compile_tsquery():
+    """ Test that free text compiles to a tsquery that requires every word """
+
+    assert compile_tsquery("working  memory!") == "working & memory"
+    assert compile_tsquery("(&|)") == ""
+
+
+def test_cursor_round_trip():
+    """ Test that pagination cursors decode to the article they were made from """
+
+    assert decode_cursor(encode_cursor(1234)) == 1234
+    assert decode_cursor("") is None
+
+
+def test_compile_validator():
+    """ Test that compiled validators parse, default, and reject arguments """
+
+    validate = compile_validator({
+        "q": {"type": str},
+        "start": {"type": int, "default": 0},
+        "experiments": {"type": json.loads, "default": "[]"}})
+    args = validate({"q": "brain"}, lambda k: "brain")["args"]
+    assert args == {"q": "brain", "start": 0, "experiments": []}
+    assert args["experiments"] is not validate(
+        {"q": "brain"}, lambda k: "brain")["args"]["experiments"]
+    assert validate({}, None)["description"] == "Missing required parameter: q"
+    assert validate({"q": "", "start": "x"}, {"q": "", "start": "x"}.get)[
+        "description"] == "Bad input for argument (type int): start"
+    assert validate({"q": "", "x": ""}, {"q": "", "x": ""}.get)[
+        "description"] == "Unexpected parameter: x"
+
+
+def test_table_rows():
+    """ Test that experiments become Experiments and Peaks rows """
+
+    experiments, locations = table_rows("123", [
+        {"id": 90003, "caption": "A", "locations": ["-26,54,14", "1,2,3,4.5"]},
+        {"caption": "B", "locations": ["not,a,peak"]}])
+    assert [(e["experiment"], e["document"]) for e in experiments] == [
+        (90003, {"caption": "A"}), (90004, {"caption": "B"})]
+    assert [(l["location"], l["x"], l["stat"], l["position"])
+            for l in locations] == [
+        ("-26,54,14", -26, None, 0), ("1,2,3,4.5", 1, 4.5, 1),
+        ("not,a,peak", None, None, 0)]
+
+
+def test_density_map():
+    """ Test that peaks are binned on the MNI grid, and that smoothing preserves mass """
+
+    volume = density_map([(0, 0, 0), (0, 0, 0), (500, 0, 0)], fwhm=0)
+    assert volume.shape == MNI_SHAPE
+    assert volume[45, 63, 36] == 2 and volume.sum() == 2
+    assert abs(density_map([(0, 0, 0)]).sum() - 1) < 1e-3
+
+
+def test_parse_document():
+    """ Test that the JSONB migration parses old rows and repairs bad ones """
+
+    assert parse_document("[{'id': 1, 'flagged': True}]", []) == (
+        [{"id": 1, "flagged": True}], False)
+    assert parse_document('<![CDATA[{"meshHeadings": []}]]>', {}) == (
+        {"meshHeadings": []}, False)
+    assert parse_document("{'meshHeadings': [", {}) == ({}, True)
+
+
+def test_votes_round_trip():
+    """ Test that votes moved out of an article are merged back the same way """
+
+    metadata = {
+        "meshHeadings": [{"name": "Brain", "vote": {
+            "up": [{"username": "a"}], "down": [{"username": "b"}]}}],
+        "space_subjects": {"radio_votes": [{"username": "a", "type": "MNI"}]},
+        "user_tags": {"b": {"tag_name": "fmri"}}}
+    experiments = [{"id": 90000, "locations": [], "T": [
+        {"tag": "memory", "vote": {"up": [{"username": "a"}], "down": []}}]}]
+    votes = legacy_votes(metadata, {90000: experiments[0]})
+    assert metadata == {"meshHeadings": [{"name": "Brain"}]}
+    merge_votes([Votes(target=target, username=username, value=value)
+                 for target, username, value in votes], metadata, experiments)
+    assert metadata["meshHeadings"][0]["vote"] == {
+        "up": [{"username": "a"}], "down": [{"username": "b"}]}
+    assert metadata["space_subjects"] == {
+        "radio_votes": [{"username": "a", "type": "MNI"}]}
+    assert metadata["user_tags"] == {"b": {"tag_name": "fmri"}}
+    assert experiments[0]["T"][0]["vote"]["up"] == [{"username": "a"}]
+
+
+def test_search_index():
+    """ Test that the in-memory index matches, updates, and removes articles """
+
+    index = search_index.InvertedIndex()
+    index.add(Articles(uniqueid=2, pmid="2", title="Working memory",
+                       authors="Smith J", abstract="", metadata=None))
+    index.add(Articles(uniqueid=1, pmid="1", title="Memory and pain",
+                       authors="Jones K", abstract="", metadata=None))
+    assert index.search("memory") == [1, 2]
+    assert index.search("the memory") == [1, 2]  # "the" is a stop word
+    assert index.search("smith[au]") == [2]
+    assert index.search("12345[PMID]") is None
+
+    index.add(Articles(uniqueid=2, pmid="2", title="Attention",
+                       authors="Smith J", abstract="", metadata=None))
+    assert index.search("memory") == [1]
+    index.remove(1)
+    assert index.search("memory") == []
+
+
+def test_search_index_rank():
+    """ Test that BM25 ranks title hits above abstract hits """
+
+    index = search_index.InvertedIndex()
+    index.add(Articles(uniqueid=1, pmid="1", title="Pain",
+                       authors="Jones K", abstract="memory", metadata=None))
+    index.add(Articles(uniqueid=2, pmid="2", title="Working memory",
+                       authors="Smith J", abstract="", metadata=None))
+    index.add(Articles(uniqueid=3, pmid="3", title="Attention",
+                       authors="Lee M", abstract="", metadata=None))
+    ranked = index.rank("memory", k=10)
+    assert [uniqueid for uniqueid, score in ranked] == [2, 1]
+    assert len(index.rank("memory", k=1)) == 1
+
+
+def test_lru_cache():
+    """ Test that the cache evicts, invalidates, and counts correctly """
+
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    cache.invalidate()
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 2, 1)
+
+
+def test_cache_for():
+    """ Test that only searches that read the experiment tables are cached
+    with them """
+
+    assert cache_for("memory") is search_cache
+    assert cache_for("memory", "t") is search_cache
+    assert cache_for("memory", "x") is experiments_cache
+    assert cache_for("memory [ALL]") is experiments_cache
+    assert cache_for("memory", experiments=True) is experiments_cache
+
+
+def test_request_metrics():
+    """ Test that latencies land in cumulative Prometheus histogram buckets """
+
+    metrics = RequestMetrics(buckets=(0.1, 1.0))
+    labels = ("Query", 1, "pull", 200)
+    metrics.observe(labels, 0.05)
+    metrics.observe(labels, 0.5)
+    text = metrics.render()
+    assert 'brainspell_requests_total{endpoint="Query",api_version="1",endpoint_type="pull",status="200"} 2' in text
+    assert 'status="200",le="0.1"} 1' in text
+    assert 'status="200",le="1.0"} 2' in text
+    assert 'status="200",le="+Inf"} 2' in text
+
+
 def test_procfile():
     """ Assert that the Procfile points to a valid Python script. """
 
@@ -199,3 +370,34 @@ def test_front_page(http_client, base_url):
     """ Test that the front page gives a 200 status code. """
     response = yield http_client.fetch(base_url)
     assert response.code == 200
+
+
+@pytest.mark.gen_test
+def test_batch(http_client, base_url):
+    """ Test that /json/batch answers each call, in order. """
+    calls = [
+        {"type": "no-such-endpoint"},
+        {"type": "batch"},
+        {"type": "list-endpoints"},
+        {"type": "v2/get-user-collections",
+         "payload": {"github_token": "token", "key": "not-an-api-key"}}
+    ]
+    response = yield http_client.fetch(
+        base_url + "/json/batch?calls=" + urllib.parse.quote(json.dumps(calls)))
+    responses = json.loads(response.body.decode("utf-8"))["responses"]
+    assert [r["success"] for r in responses] == [0, 0, 1, 0]
+    assert responses[0]["description"] == "Endpoint undefined."
+    assert "/json/batch" in responses[2]["endpoints"]
+    assert responses[3]["description"] == "Invalid API key."
+
+
+@pytest.mark.gen_test
+def test_coactivation_map_bounds(http_client, base_url):
+    """ Test that /json/coactivation-map rejects radii and FWHMs that are out
+    of bounds, before it touches the database. """
+    for query in ["radius=100", "radius=nan", "fwhm=1000", "fwhm=-1"]:
+        response = yield http_client.fetch(
+            base_url + "/json/coactivation-map?coordinate=0,0,0&" + query,
+            raise_error=False)
+        assert response.code == 422
+        assert json.loads(response.body.decode("utf-8"))["success"] == 0
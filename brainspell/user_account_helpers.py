@@ -6,10 +6,23 @@ from models import *
 
 from base64 import b64decode, b64encode
 import json
-import requests
-from search_helpers import get_article_object
+import os
+from collections import namedtuple
+from caching import LRUCache
+from prepared_queries import fetch_user
+from search_helpers import get_article_summaries
 
-GET = requests.get
+GET = "GET"
+PUT = "PUT"
+
+# the user that a request's API key belongs to
+Principal = namedtuple("Principal", ["userid", "username"])
+
+# valid API keys, mapped to their Principals; invalid keys aren't cached, so
+# that a user can use their key as soon as they've registered
+api_key_cache = LRUCache(
+    max_size=int(os.environ.get("API_KEY_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("API_KEY_CACHE_TTL", 300)))
 
 
 async def create_pmid(handler, user, repo_name, pmid, github_token):
@@ -19,7 +32,7 @@ async def create_pmid(handler, user, repo_name, pmid, github_token):
         "message": "Add {0}.json".format(p),
         "content": encode_for_github(
             {})}
-    await handler.github_request(requests.put,
+    await handler.github_request(PUT,
                                  "repos/{0}/{1}/contents/{2}.json".format(
                                      user,
                                      repo_name,
@@ -43,7 +56,7 @@ async def get_or_create_pmid(handler, user, collection_name, pmid, github_token)
         # The article didn't already exist
         await create_pmid(handler, user, repo_name, p, github_token)
         pmid_contents = await handler.github_request(
-            requests.get, "repos/{0}/{1}/contents/{2}.json".format(
+            GET, "repos/{0}/{1}/contents/{2}.json".format(
                 user, repo_name, p), github_token)
         return pmid_contents
 
@@ -73,19 +86,32 @@ def get_collection_from_repo_name(name):
     return name[len("brainspell-neo-collection-"):]
 
 
+def get_principal(api_key):
+    """
+    Return the Principal (the user) that an API key belongs to, or None if
+    the key isn't valid. Valid keys are cached, so most requests don't
+    query the database to authenticate.
+    """
+
+    principal = api_key_cache.get(api_key)
+    if principal is None and api_key:
+        user = fetch_user(api_key)
+        if user is not None:
+            principal = Principal(*user)
+            api_key_cache.put(api_key, principal)
+    return principal
+
+
 def get_github_username_from_api_key(api_key):
     """ Fetch the GitHub username corresponding to a given API key. """
 
-    user = User.select().where((User.password == api_key))
-    user_obj = next(user.execute())
-    return user_obj.username
+    return get_principal(api_key).username
 
 
 def valid_api_key(api_key):
     """ Return whether an API key exists in our database. """
 
-    user = User.select().where((User.password == api_key))
-    return user.execute().count >= 1
+    return get_principal(api_key) is not None
 
 
 def get_user_object_from_api_key(api_key):
@@ -106,7 +132,11 @@ def register_github_user(user_dict):
         # password (a.k.a. API key) is a hash of the Github ID
         hasher.update(str(user_dict["id"]).encode('utf-8'))
         password = hasher.hexdigest()
-        User.create(username=username, emailaddress=email, password=password)
+        user = User.create(
+            username=username,
+            emailaddress=email,
+            password=password)
+        api_key_cache.put(password, Principal(user.userid, username))
         return True
     else:
         return False  # user already exists
@@ -310,7 +340,7 @@ def add_unmapped_article_to_cached_collections(api_key, pmid, collection_name):
             User.collections).where(
             User.password == api_key).execute())[0]
     collections = json.loads(query.collections)
-    relevant_article = list(get_article_object(pmid))[0]
+    relevant_article = get_article_summaries([pmid])[str(pmid)]
     target_collection = [
         x for x in collections if x['name'] == collection_name][0]
     target_collection['unmapped_articles'].append({
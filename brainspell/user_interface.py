@@ -13,7 +13,7 @@ class MainHandler(BaseHandler):
 
     route = ""
 
-    def get(self):
+    async def get(self):
         try:  # handle failures in bulk_add
             submitted_bulk_add = int(self.get_argument("success", 0))
         except BaseException:
@@ -29,7 +29,7 @@ class MainHandler(BaseHandler):
             registered_right_now = 0
 
         custom_params = {
-            "number_of_queries": get_number_of_articles(),
+            "number_of_queries": await run_query(get_number_of_articles),
             "success": submitted_bulk_add,
             "failure": failure_in_submitting_bulk_add,
             # boolean that indicates if someone has just registered
@@ -1,3 +1,4 @@
+import inspect
 import json
 
 import tornado.websocket
@@ -66,26 +67,15 @@ class EndpointWebSocket(tornado.websocket.WebSocketHandler):
         """
         messageDict = json.loads(message)
 
-        if messageDict["type"] not in endpoints:
-            self.write_message({
-                "success": 0,
-                "description": "Endpoint undefined."
-            })
-        else:
-            func = endpoints[messageDict["type"]]
-            payload = {}
-            if "payload" in messageDict:
-                payload = messageDict["payload"]
-
-            # Initialize long running compute messages
-            f_stop = threading.Event()
-            self.issue_periodic_write(f_stop)
+        # Initialize long running compute messages
+        f_stop = threading.Event()
+        self.issue_periodic_write(f_stop)
 
-            res = await api_call(func, payload)
+        res = await dispatch(messageDict, self)
 
-            f_stop.set()
+        f_stop.set()
 
-            self.write_message(json.dumps(res))
+        self.write_message(json.dumps(res))
 
     def on_close(self):
         # cleanup
@@ -94,12 +84,64 @@ class EndpointWebSocket(tornado.websocket.WebSocketHandler):
     # set_default_headers = BaseHandler.set_default_headers
 
 
-def api_call(func, args={}):
+def endpoint_instance(func, handler):
+    """
+    Return an instance of an endpoint class that shares the application and
+    request of the handler that received the call, so that the endpoint's
+    process method can use its own methods (github_request, validate, etc.)
+    and self.request, as it would if it had been requested directly.
+    """
+
+    endpoint = func(handler.application, handler.request)
+    # constructing a handler takes over the connection's close callback, so
+    # give it back to the handler that owns the connection
+    handler.request.connection.set_close_callback(
+        handler.on_connection_close)
+    return endpoint
+
+
+async def dispatch(call, handler):
+    """
+    Make one API call, given as a dictionary of the form
+    {"type": endpoint name, "payload": arguments dict}, on behalf of the
+    handler that received it, and return the response. Used by the
+    WebSocket API and /json/batch.
+
+    Endpoints that write their own response (handle_finishing) can't be
+    called this way, since only the handler that received the call can
+    write to its connection.
+    """
+
+    if not isinstance(call, dict) or call.get("type") not in endpoints:
+        return {
+            "success": 0,
+            "description": "Endpoint undefined."
+        }
+    func = endpoints[call["type"]]
+    if func.handle_finishing or func is json_api.BatchEndpointHandler:
+        return {
+            "success": 0,
+            "description": "This endpoint can't be called with a message."
+        }
+    try:
+        return await api_call(func, call.get("payload", {}), handler)
+    except BaseException:
+        return {
+            "success": 0,
+            "description": "The call to {0} failed.".format(call["type"])
+        }
+    finally:
+        release_connection()
+
+
+async def api_call(func, args, handler):
     """ Return the output of a call to an endpoint, given an arguments dict.
 
-    Take the name of an Endpoint class and an arguments dict, where the keys
+    Take the name of an Endpoint class, an arguments dict, where the keys
     of the arguments dict are those specified in the Endpoint.parameters dict,
-    plus the "key" parameter, if the endpoint is a PUSH_API endpoint.
+    plus the "key" parameter, if the endpoint is a PUSH_API endpoint, and the
+    handler that received the call. The endpoint runs on an instance that
+    shares the handler's request (see endpoint_instance).
 
     (For a complete list of arguments for an endpoint, go to
         http://localhost:5000/json/{ENDPOINT_NAME}/help)
@@ -107,7 +149,7 @@ def api_call(func, args={}):
     Do not modify the args dict passed in.
 
     Ex:
-    >>> api_call(RandomQueryEndpointHandler)
+    >>> await api_call(RandomQueryEndpointHandler, {}, self)
     {
        'success': 1,
        'articles': [
@@ -120,9 +162,9 @@ def api_call(func, args={}):
        ]
     }
 
-    >>> api_call(QueryEndpointHandler, {
+    >>> await api_call(QueryEndpointHandler, {
         "q": "brain"
-        })
+        }, self)
     {
        'success': 1,
        'articles': [
@@ -141,14 +183,29 @@ def api_call(func, args={}):
         func, args, lambda k: args[k])
 
     if argsDict["success"] == 1:
+        if "key" in argsDict["args"]:
+            argsDict["args"]["principal"] = await run_query(
+                get_principal, argsDict["args"]["key"])
         # validate API key if push endpoint
         if func.endpoint_type == Endpoint.PULL_API or (
-            func.endpoint_type == Endpoint.PUSH_API and valid_api_key(
-                argsDict["args"]["key"])):
+            func.endpoint_type == Endpoint.PUSH_API and
+                argsDict["args"]["principal"] is not None):
             response = {
                 "success": 1
             }
-            response = func.process(func, response, argsDict["args"])
+            endpoint = endpoint_instance(func, handler)
+            # a WebSocket's handshake has already been answered, so only
+            # /json/batch can set the cookie
+            if func.endpoint_type == Endpoint.PUSH_API and isinstance(
+                    handler, BaseHandler):
+                handler.mark_written()
+            if func.blocking:
+                response = await run_blocking(
+                    endpoint.process, response, argsDict["args"])
+            else:
+                response = endpoint.process(response, argsDict["args"])
+                if inspect.isawaitable(response):
+                    response = await response
             return response
         else:
             return {"success": 0, "description": "Invalid API key."}